@@ -4,13 +4,33 @@
 from trytond.pool import Pool
 from .sale import *
 from .move import *
+from .advance import *
+from .einvoice import *
+from .configuration import *
+from .stock import *
+from .statement import *
 
 def register():
     Pool.register(
         SalePaymentForm,
+        SaleBatchPaymentStart,
+        SaleBatchPaymentResult,
         Move,
         Line,
+        Reconciliation,
+        AdvanceLine,
+        AdvanceAllocation,
+        EInvoiceJob,
+        Invoice,
+        Configuration,
+        Statement,
+        Journal,
+        Period,
+        Sale,
+        StockMove,
+        StatementLine,
         module='nodux_sale_payment_advanced_payment', type_='model')
     Pool.register(
         WizardSalePayment,
+        WizardSaleBatchPayment,
         module='nodux_sale_payment_advanced_payment', type_='wizard')
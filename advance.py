@@ -0,0 +1,423 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from decimal import Decimal
+from sql import Null, For, Literal
+from sql.functions import CurrentTimestamp
+from trytond.model import ModelSQL, fields
+from trytond.rpc import RPC
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond import backend
+
+__all__ = ['AdvanceLine', 'AdvanceAllocation']
+_ZERO = Decimal('0.0')
+
+
+class AdvanceLine(ModelSQL):
+    'Advance Line'
+    __name__ = 'sale.advance.line'
+    _rec_name = 'line'
+
+    party = fields.Many2One('party.party', 'Party', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    line = fields.Many2One('account.move.line', 'Move Line', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AdvanceLine, cls).__setup__()
+        cls._sql_constraints += [
+            ('line_uniq', 'UNIQUE(line)',
+                'La linea de anticipo debe ser unica.'),
+            ]
+        cls._order.insert(0, ('line', 'ASC'))
+        cls.__rpc__.update({
+                'get_balances': RPC(),
+                })
+        cls._error_messages.update({
+                'advance_changed': ('El anticipo del tercero "%s" fue '
+                    'utilizado en otro pago. Vuelva a abrir el pago para '
+                    'utilizar el anticipo disponible.'),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(AdvanceLine, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['party', 'company'], 'add')
+
+        if created:
+            cls._backfill()
+
+    @classmethod
+    def _backfill(cls):
+        'Fill the ledger with the advance lines that already exist'
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Account = pool.get('account.account')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        line = MoveLine.__table__()
+        account = Account.__table__()
+
+        query = line.join(account, condition=line.account == account.id
+            ).select(line.party, account.company, line.id, line.credit,
+                Literal(Transaction().user), CurrentTimestamp(),
+                where=(line.party != Null)
+                & (account.kind == 'receivable')
+                & (line.state == 'valid')
+                & (line.reconciliation == Null)
+                & (line.maturity_date == Null)
+                & (line.credit > 0))
+        cursor.execute(*table.insert([table.party, table.company,
+                    table.line, table.amount, table.create_uid,
+                    table.create_date], query))
+
+    @staticmethod
+    def is_advance(line):
+        'Return True if the move line is an open advance of its party'
+        return bool(line.party
+            and line.account.kind == 'receivable'
+            and line.state == 'valid'
+            and not line.reconciliation
+            and not line.maturity_date
+            and line.credit > _ZERO)
+
+    @classmethod
+    def update_lines(cls, lines):
+        'Refresh the ledger entries of the given move lines'
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        line_ids = list(set(l.id for l in lines))
+        if not line_ids:
+            return
+        cls.delete(cls.search([('line', 'in', line_ids)]))
+
+        to_create = []
+        for line in MoveLine.browse(line_ids):
+            if not cls.is_advance(line):
+                continue
+            to_create.append({
+                    'party': line.party.id,
+                    'company': line.account.company.id,
+                    'line': line.id,
+                    'amount': line.credit,
+                    })
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def _query_advances(cls, party_ids, company_id):
+        '''
+        Return the query of the open advance entries of the parties for the
+        company that are not linked to an invoice nor allocated to a sale
+        '''
+        pool = Pool()
+        InvoiceMoveLine = pool.get('account.invoice-account.move.line')
+        Allocation = pool.get('sale.advance.allocation')
+        table = cls.__table__()
+        invoice_line = InvoiceMoveLine.__table__()
+        allocation = Allocation.__table__()
+
+        return table.join(invoice_line, 'LEFT',
+            condition=invoice_line.line == table.line
+            ).join(allocation, 'LEFT',
+                condition=allocation.line == table.line
+            ).select(table.id, table.party, table.line, table.amount,
+            where=table.party.in_(party_ids)
+            & (table.company == company_id)
+            & (invoice_line.id == Null)
+            & (allocation.id == Null),
+            order_by=table.line.asc)
+
+    @classmethod
+    def get_advances(cls, party, company):
+        '''
+        Return the open advance entries of the party for the company
+        that are not linked to an invoice
+        '''
+        cursor = Transaction().cursor
+        cursor.execute(*cls._query_advances([party.id], company.id))
+        return cls.browse([r[0] for r in cursor.fetchall()])
+
+    @classmethod
+    def get_balances(cls, party_ids, company_id=None):
+        '''
+        Return a list with a dictionary for each party id with the
+        available advance amount and the ids of its advance lines
+        '''
+        cursor = Transaction().cursor
+        if company_id is None:
+            company_id = Transaction().context.get('company')
+
+        balances = dict((p, {'party': p, 'amount': _ZERO, 'lines': []})
+            for p in party_ids)
+        ids = list(balances.keys())
+        for i in range(0, len(ids), cursor.IN_MAX):
+            cursor.execute(*cls._query_advances(ids[i:i + cursor.IN_MAX],
+                    company_id))
+            for _, party_id, line_id, amount in cursor.fetchall():
+                balance = balances[party_id]
+                # SQLite returns float for numeric columns
+                balance['amount'] += Decimal(str(amount))
+                balance['lines'].append(line_id)
+        return [balances[p] for p in party_ids]
+
+    @classmethod
+    def lock(cls, lines):
+        '''
+        Lock the ledger entries of the move lines until the end of the
+        transaction and return the entries that are still open and not
+        allocated to a sale.
+        Concurrent payments of the same advance wait for the lock and then
+        fail with a serialization error, which makes the request retry,
+        because consume deletes the entries it uses.
+        '''
+        pool = Pool()
+        Allocation = pool.get('sale.advance.allocation')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        allocation = Allocation.__table__()
+
+        line_ids = [l.id for l in lines]
+        if not line_ids:
+            return []
+        query = table.join(allocation, 'LEFT',
+            condition=allocation.line == table.line
+            ).select(table.id,
+            where=table.line.in_(line_ids) & (allocation.id == Null))
+        if backend.name() == 'postgresql':
+            query.for_ = For('UPDATE', table)
+        cursor.execute(*query)
+        return cls.browse([r[0] for r in cursor.fetchall()])
+
+    @classmethod
+    def check_available(cls, party, lines, amount):
+        '''
+        Lock the advance lines and check they are still open with the
+        amount read when the payment was opened.
+        '''
+        advances = cls.lock(lines)
+        available = sum((a.amount for a in advances), _ZERO)
+        if len(advances) != len(lines) or available != amount:
+            cls.raise_user_error('advance_changed', (party.rec_name,))
+        return advances
+
+    @classmethod
+    def consume(cls, sale, invoice, lines, amount):
+        '''
+        Allocate amount of the advance lines to the sale, oldest lines
+        first. Posted moves are not modified: a partially used line is
+        closed by a new move that splits it into the used and the remaining
+        amount.
+        Return True if part of an advance remains open.
+        '''
+        pool = Pool()
+        Period = pool.get('account.period')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Configuration = pool.get('sale.configuration')
+        Allocation = pool.get('sale.advance.allocation')
+
+        allocations = []
+        split = None
+        left = amount
+        for line in sorted(lines, key=lambda l: (l.date, l.id)):
+            if left <= _ZERO:
+                break
+            used = min(line.credit, left)
+            left -= used
+            if used < line.credit:
+                split = line, used
+                continue
+            allocations.append({
+                    'sale': sale.id,
+                    'party': sale.party.id,
+                    'advance': line.id,
+                    'line': line.id,
+                    'amount': used,
+                    'date': sale.sale_date,
+                    })
+
+        remaining = _ZERO
+        if split:
+            line, used = split
+            remaining = line.credit - used
+            config = Configuration.get_payment_config(sale.company,
+                sale.sale_date)
+            description = invoice.number if invoice else sale.reference
+            journal = config['revenue_journal']
+            period = (config['period']
+                or Period.find(sale.company.id, date=sale.sale_date))
+            move, = Move.create([{
+                        'period': period,
+                        'journal': journal,
+                        'date': sale.sale_date,
+                        'origin': str(sale),
+                        'description': sale.reference,
+                        }])
+            values = {
+                'move': move.id,
+                'account': line.account.id,
+                'party': line.party.id,
+                'description': description,
+                'journal': journal,
+                'period': period,
+                }
+            closing, used_line, _ = MoveLine.create([
+                    dict(values, debit=line.credit, credit=_ZERO),
+                    dict(values, debit=_ZERO, credit=used),
+                    dict(values, debit=_ZERO, credit=remaining),
+                    ])
+            Move.post([move])
+            MoveLine.reconcile([line, closing])
+            allocations.append({
+                    'sale': sale.id,
+                    'party': sale.party.id,
+                    'advance': line.id,
+                    'line': used_line.id,
+                    'amount': used,
+                    'date': sale.sale_date,
+                    })
+
+        if allocations:
+            Allocation.create(allocations)
+            # the used lines leave the ledger, a concurrent payment waiting
+            # for their lock fails with a serialization error and retries
+            line_ids = set()
+            for allocation in allocations:
+                line_ids.update((allocation['advance'], allocation['line']))
+            cls.delete(cls.search([
+                        ('line', 'in', list(line_ids)),
+                        ]))
+        return remaining > _ZERO
+
+    @classmethod
+    def reconcile_sale(cls, sale):
+        'Reconcile the invoices of the sale with the advances it used'
+        cls.reconcile_sales([sale])
+
+    @classmethod
+    def _get_reconcile_lines(cls, sales):
+        '''
+        Return for each sale id a dictionary with the amount of its
+        unreconciled receivable lines: the lines of its invoices, the
+        advance lines allocated to it and the lines of the moves whose
+        origin is the sale that are not open advances.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Invoice = pool.get('account.invoice')
+        SaleInvoice = pool.get('sale.sale-account.invoice')
+        Allocation = pool.get('sale.advance.allocation')
+        cursor = Transaction().cursor
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        invoice = Invoice.__table__()
+        sale_invoice = SaleInvoice.__table__()
+        allocation = Allocation.__table__()
+        advance = cls.__table__()
+
+        accounts = dict((s.id, s.party.account_receivable.id) for s in sales)
+        result = dict((s.id, {}) for s in sales)
+        sale_ids = list(result.keys())
+        amount = line.debit - line.credit
+        for i in range(0, len(sale_ids), cursor.IN_MAX):
+            sub_ids = sale_ids[i:i + cursor.IN_MAX]
+            origins = ['sale.sale,%s' % x for x in sub_ids]
+            queries = [
+                line.join(invoice, condition=line.move == invoice.move
+                    ).join(sale_invoice,
+                    condition=sale_invoice.invoice == invoice.id
+                    ).select(sale_invoice.sale, line.id, line.account,
+                    amount,
+                    where=sale_invoice.sale.in_(sub_ids)
+                    & (line.reconciliation == Null)),
+                line.join(allocation, condition=allocation.line == line.id
+                    ).select(allocation.sale, line.id, line.account, amount,
+                    where=allocation.sale.in_(sub_ids)
+                    & (line.reconciliation == Null)),
+                line.join(move, condition=line.move == move.id
+                    ).join(advance, 'LEFT', condition=advance.line == line.id
+                    ).select(move.origin, line.id, line.account, amount,
+                    where=move.origin.in_(origins)
+                    & (line.reconciliation == Null)
+                    & (advance.id == Null)),
+                ]
+            for query in queries:
+                cursor.execute(*query)
+                for sale_id, line_id, account_id, line_amount in cursor.fetchall():
+                    if not isinstance(sale_id, (int, long)):
+                        sale_id = int(sale_id.split(',')[1])
+                    if account_id == accounts[sale_id]:
+                        result[sale_id][line_id] = line_amount
+        return result
+
+    @classmethod
+    def reconcile_sales(cls, sales):
+        '''
+        Reconcile the invoices of the sales with the advances they used
+        when they are balanced
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        for sale_id, lines in cls._get_reconcile_lines(sales).iteritems():
+            if lines and sum(lines.values(), _ZERO) == _ZERO:
+                MoveLine.reconcile(MoveLine.browse(list(lines.keys())))
+
+    @classmethod
+    def reconcile_pending(cls, date_from=None, date_to=None):
+        '''
+        Reconcile the sales with unreconciled advance allocations between
+        the dates
+        '''
+        pool = Pool()
+        Allocation = pool.get('sale.advance.allocation')
+        Sale = pool.get('sale.sale')
+
+        domain = [('line.reconciliation', '=', None)]
+        if date_from:
+            domain.append(('date', '>=', date_from))
+        if date_to:
+            domain.append(('date', '<=', date_to))
+        sale_ids = set(a.sale.id for a in Allocation.search(domain))
+        if sale_ids:
+            cls.reconcile_sales(Sale.browse(list(sale_ids)))
+
+
+class AdvanceAllocation(ModelSQL):
+    'Advance Allocation'
+    __name__ = 'sale.advance.allocation'
+
+    sale = fields.Many2One('sale.sale', 'Sale', required=True, select=True,
+        ondelete='CASCADE', readonly=True)
+    party = fields.Many2One('party.party', 'Party', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    advance = fields.Many2One('account.move.line', 'Advance', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    line = fields.Many2One('account.move.line', 'Move Line', required=True,
+        ondelete='CASCADE', readonly=True,
+        help='The line reconciled with the invoice of the sale.')
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    date = fields.Date('Date', required=True, select=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AdvanceAllocation, cls).__setup__()
+        cls._sql_constraints += [
+            ('line_uniq', 'UNIQUE(line)',
+                'Un anticipo solo puede aplicarse a una venta.'),
+            ]
+        cls._order.insert(0, ('date', 'ASC'))
@@ -0,0 +1,216 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Export of the advance usage of the parties.
+
+Run on the database, the CSV is written to the output file or stdout:
+
+    python -m trytond.modules.nodux_sale_payment_advanced_payment.audit \\
+        -c trytond.conf -d DATABASE --from 2016-01-01 --to 2016-01-31 \\
+        -o anticipos.csv
+
+For each party it lists the advance balance before --from, every advance
+received and every amount applied to a sale between the dates with the
+remaining advance. The rows are read CHUNK at a time, from a server-side
+cursor on PostgreSQL, and written as they are read so the memory used does
+not depend on the number of lines.
+'''
+import argparse
+import csv
+import datetime
+import sys
+from decimal import Decimal
+from sql import Null, Literal, Union
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+from sql.operators import Like, Not
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+_ZERO = Decimal('0.0')
+# Rows fetched from the database at a time
+CHUNK = 2000
+OPENING, RECEIVED, APPLIED = 0, 1, 2
+HEADER = ['Tercero', 'Fecha', 'Asiento', 'Recibido', 'Aplicado', 'Restante',
+    'Venta']
+
+
+def fetch(query, size=CHUNK):
+    '''
+    Yield the rows of the query fetched size rows at a time.
+    On PostgreSQL the rows are read from a server-side cursor.
+    '''
+    cursor = Transaction().cursor
+    if backend.name() == 'postgresql':
+        cursor = cursor._conn.cursor('sale_advance_audit')
+        cursor.itersize = size
+    try:
+        cursor.execute(*query)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        if cursor is not Transaction().cursor:
+            cursor.close()
+
+
+def get_query(company_id, date_from, date_to):
+    '''
+    Return the query of the advance movements of the parties ordered by
+    party and date: the balance before date_from, the advances received
+    and the amounts applied to sales between the dates. On the same date
+    the advances received come before the amounts applied.
+    '''
+    pool = Pool()
+    MoveLine = pool.get('account.move.line')
+    Move = pool.get('account.move')
+    Account = pool.get('account.account')
+    Allocation = pool.get('sale.advance.allocation')
+    Sale = pool.get('sale.sale')
+    Party = pool.get('party.party')
+    InvoiceMoveLine = pool.get('account.invoice-account.move.line')
+    line = MoveLine.__table__()
+    move = Move.__table__()
+    account = Account.__table__()
+    allocation = Allocation.__table__()
+    sale = Sale.__table__()
+    party = Party.__table__()
+    invoice_line = InvoiceMoveLine.__table__()
+    advance_line = MoveLine.__table__()
+    advance_move = Move.__table__()
+    applied_sale = Sale.__table__()
+
+    # The advances of the ledger: the payments of an invoice are not
+    # advances and the lines of the moves created by a sale split an
+    # advance that is already counted
+    received = line.join(move, condition=line.move == move.id
+        ).join(account, condition=line.account == account.id
+        ).join(invoice_line, 'LEFT',
+            condition=invoice_line.line == line.id)
+    received_where = ((line.party != Null)
+        & (invoice_line.id == Null)
+        & (account.kind == 'receivable')
+        & (account.company == company_id)
+        & (line.state == 'valid')
+        & (line.maturity_date == Null)
+        & (line.credit > 0)
+        & ((move.origin == Null)
+            | Not(Like(move.origin, 'sale.sale,%'))))
+    applied = allocation.join(sale, condition=allocation.sale == sale.id)
+    applied_where = sale.company == company_id
+
+    union = Union(
+        received.select(line.party, Literal(OPENING).as_('kind'),
+            Literal(None).as_('date'), Literal(None).as_('line'),
+            Literal(None).as_('sale'),
+            Sum(line.credit).as_('amount'),
+            where=received_where & (line.date < date_from),
+            group_by=line.party),
+        applied.select(allocation.party, Literal(OPENING), Literal(None),
+            Literal(None), Literal(None), -Sum(allocation.amount),
+            where=applied_where & (allocation.date < date_from),
+            group_by=allocation.party),
+        received.select(line.party, Literal(RECEIVED), line.date,
+            line.id, Literal(None), line.credit,
+            where=received_where & (line.date >= date_from)
+            & (line.date <= date_to)),
+        applied.select(allocation.party, Literal(APPLIED),
+            allocation.date, allocation.advance, allocation.sale,
+            allocation.amount,
+            where=applied_where & (allocation.date >= date_from)
+            & (allocation.date <= date_to)),
+        all_=True)
+
+    return union.join(party, condition=union.party == party.id
+        ).join(advance_line, 'LEFT',
+            condition=union.line == advance_line.id
+        ).join(advance_move, 'LEFT',
+            condition=advance_line.move == advance_move.id
+        ).join(applied_sale, 'LEFT',
+            condition=union.sale == applied_sale.id
+        ).select(union.party, party.name, union.kind, union.date,
+            advance_move.number, applied_sale.reference, union.amount,
+            order_by=[union.party,
+                Coalesce(union.date, date_from - datetime.timedelta(days=1)
+                    ).asc,
+                union.kind.asc, union.line.asc])
+
+
+def get_rows(company_id, date_from, date_to):
+    '''
+    Yield the audit rows: one row for each advance received and each
+    amount applied to a sale with the remaining advance of the party.
+    Only the movements of the current party are kept in memory.
+    '''
+    party_id = None
+    remaining = _ZERO
+    for row in fetch(get_query(company_id, date_from, date_to)):
+        row_party, name, kind, date, number, reference, amount = row
+        amount = Decimal(str(amount or 0))
+        if row_party != party_id:
+            party_id, remaining = row_party, _ZERO
+        if kind == OPENING:
+            remaining += amount
+            continue
+        received = applied = _ZERO
+        if kind == RECEIVED:
+            received = amount
+            remaining += amount
+        else:
+            applied = amount
+            remaining -= amount
+        yield [name, date, number, received, applied, remaining,
+            reference]
+
+
+def export(output, company_id, date_from, date_to):
+    'Write the audit rows of the company between the dates as CSV'
+    writer = csv.writer(output)
+    writer.writerow(HEADER)
+    for row in get_rows(company_id, date_from, date_to):
+        writer.writerow([unicode(v).encode('utf-8') if v is not None else ''
+                for v in row])
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='user', default='admin')
+    parser.add_argument('--from', dest='date_from', type=_date,
+        required=True)
+    parser.add_argument('--to', dest='date_to', type=_date, required=True)
+    parser.add_argument('-o', '--output', dest='output')
+    options = parser.parse_args(argv)
+
+    if options.config:
+        config.update_etc(options.config)
+    Pool(options.database).init()
+
+    with Transaction().start(options.database, 0, readonly=True):
+        pool = Pool()
+        User = pool.get('res.user')
+        user, = User.search([('login', '=', options.user)])
+        if options.output:
+            with open(options.output, 'wb') as output:
+                export(output, user.company.id, options.date_from,
+                    options.date_to)
+        else:
+            export(sys.stdout, user.company.id, options.date_from,
+                options.date_to)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
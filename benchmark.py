@@ -0,0 +1,324 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Microbenchmarks of the payment wizard.
+
+Run on a local database where this module is installed, the company has a
+chart of accounts, an open fiscal year and a draft statement with tipo_pago
+on the sale device of the user:
+
+    python -m trytond.modules.nodux_sale_payment_advanced_payment.benchmark \\
+        -c trytond.conf -d DATABASE --sale-template SALE_ID -o result.json
+
+SALE_ID is a draft sale with at least one goods line. It is copied for each
+scenario. The fixtures (parties and receivable lines) are committed once and
+reused by the next runs, the payments themselves are rolled back.
+
+Each phase reports its wall time, SQL statements and rows returned. The
+advance_query phase runs the open advance predicate on account.move.line. On
+PostgreSQL it also reports the rows scanned and the buffers used, measured with
+EXPLAIN ANALYZE, they must follow the open advances and not the history size.
+Pass --compare with a previous result to list the regressions.
+
+--import-budget SECONDS checks, without a database, that importing the
+module on top of trytond takes less than SECONDS.
+'''
+import argparse
+import json
+import subprocess
+import sys
+import time
+from decimal import Decimal
+
+from sql import Null
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .instrumentation import QueryCounter
+
+HISTORY_SIZES = [10, 1000, 50000]
+SALE_SIZES = [1, 50, 500]
+ADVANCE_LINES = 3
+CHUNK = 1000
+THRESHOLD = 0.2
+IMPORT_BUDGET = 0.5
+_IMPORT_SCRIPT = '''
+import time
+import trytond.model, trytond.wizard, trytond.pool
+start = time.time()
+import %s
+print(time.time() - start)
+'''
+
+
+def _party(history, advance):
+    'Return the fixture party with the history lines, create it if needed'
+    pool = Pool()
+    Party = pool.get('party.party')
+    Move = pool.get('account.move')
+    Period = pool.get('account.period')
+    Date = pool.get('ir.date')
+    Configuration = pool.get('sale.configuration')
+    User = pool.get('res.user')
+
+    name = 'benchmark-%s-%s' % (history, 'advance' if advance else 'plain')
+    parties = Party.search([('name', '=', name)])
+    if parties:
+        return parties[0]
+    party, = Party.create([{
+                'name': name,
+                'addresses': [('create', [{}])],
+                }])
+
+    company = User(Transaction().user).company
+    today = Date.today()
+    config = Configuration.get_payment_config(company, today)
+    period = Period.find(company.id, date=today)
+    receivable = party.account_receivable.id
+
+    def move(debit_line):
+        amount = Decimal('10.00')
+        lines = [{
+                'party': party.id,
+                'account': receivable,
+                'debit': amount if debit_line else Decimal(0),
+                'credit': Decimal(0) if debit_line else amount,
+                'maturity_date': today if debit_line else None,
+                }, {
+                'account': party.account_payable.id,
+                'debit': Decimal(0) if debit_line else amount,
+                'credit': amount if debit_line else Decimal(0),
+                }]
+        return {
+            'period': period,
+            'journal': config['revenue_journal'],
+            'date': today,
+            'lines': [('create', lines)],
+            }
+
+    vlist = [move(True) for _ in range(history)]
+    if advance:
+        vlist += [move(False) for _ in range(ADVANCE_LINES)]
+    for i in range(0, len(vlist), CHUNK):
+        Move.post(Move.create(vlist[i:i + CHUNK]))
+    return party
+
+
+def _sale(template, party, size):
+    'Return a copy of the template sale for the party with size lines'
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    SaleLine = pool.get('sale.line')
+
+    invoice_address = party.address_get(type='invoice')
+    shipment_address = party.address_get(type='delivery')
+    sale, = Sale.copy([template], {
+            'party': party.id,
+            'invoice_address': invoice_address.id if invoice_address else None,
+            'shipment_address': (shipment_address.id
+                if shipment_address else None),
+            'lines': None,
+            })
+    line = template.lines[0]
+    SaleLine.copy([line] * size, {'sale': sale.id})
+    return Sale(sale.id)
+
+
+def _advance_query(party):
+    'Return the query of the open advance lines of the party'
+    pool = Pool()
+    MoveLine = pool.get('account.move.line')
+    Account = pool.get('account.account')
+    line = MoveLine.__table__()
+    account = Account.__table__()
+
+    return line.join(account, condition=line.account == account.id
+        ).select(line.id,
+        where=(line.party == party.id)
+        & (account.kind == 'receivable')
+        & (line.state == 'valid')
+        & (line.reconciliation == Null)
+        & (line.maturity_date == Null)
+        & (line.credit > 0))
+
+
+def _scanned(plan):
+    'Return the rows read by the scan nodes of the plan'
+    rows = 0
+    if 'Scan' in plan['Node Type']:
+        rows += ((plan['Actual Rows'] + plan.get('Rows Removed by Filter', 0))
+            * plan['Actual Loops'])
+    for child in plan.get('Plans', []):
+        rows += _scanned(child)
+    return rows
+
+
+def explain(query):
+    '''
+    Return the rows scanned and the buffers used to run the query,
+    measured with EXPLAIN ANALYZE on PostgreSQL
+    '''
+    cursor = Transaction().cursor
+    sql, params = tuple(query)
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    return {
+        'scanned': _scanned(plan),
+        'buffers': (plan.get('Shared Hit Blocks', 0)
+            + plan.get('Shared Read Blocks', 0)),
+        }
+
+
+def _measure(results, scenario, phase, func):
+    start = time.time()
+    with QueryCounter() as counter:
+        value = func()
+    results.append({
+            'scenario': scenario,
+            'phase': phase,
+            'wall': time.time() - start,
+            'queries': counter.queries,
+            'rows': counter.rows,
+            })
+    return value
+
+
+def run_scenario(template, history, size, advance, results):
+    pool = Pool()
+    WizardSalePayment = pool.get('sale.payment', type='wizard')
+    MoveLine = pool.get('account.move.line')
+
+    scenario = 'history=%s lines=%s advance=%s' % (history, size, advance)
+    party = _party(history, advance)
+    Transaction().cursor.commit()
+
+    _measure(results, scenario, 'advance_query',
+        lambda: MoveLine.search([
+                ('party', '=', party.id),
+                ('account.kind', '=', 'receivable'),
+                ('state', '=', 'valid'),
+                ('reconciliation', '=', None),
+                ('maturity_date', '=', None),
+                ('credit', '>', 0),
+                ]))
+    if backend.name() == 'postgresql':
+        results[-1].update(explain(_advance_query(party)))
+
+    sale = _sale(template, party, size)
+    with Transaction().set_context(active_id=sale.id):
+        session_id, _, _ = WizardSalePayment.create()
+        payment = WizardSalePayment(session_id)
+        values = _measure(results, scenario, 'default_start',
+            lambda: payment.default_start(None))
+        for name, value in values.iteritems():
+            setattr(payment.start, name, value)
+        if advance:
+            payment.start.utilizar_anticipo = True
+            changes = _measure(results, scenario,
+                'on_change_utilizar_anticipo',
+                payment.start.on_change_utilizar_anticipo)
+            for name, value in changes.iteritems():
+                setattr(payment.start, name, value)
+        _measure(results, scenario, 'transition_pay_',
+            payment.transition_pay_)
+        WizardSalePayment.delete(session_id)
+    Transaction().cursor.rollback()
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    'Return the measures of results worse than baseline by threshold'
+    previous = dict(((r['scenario'], r['phase']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get((result['scenario'], result['phase']))
+        if not old:
+            continue
+        for key in ('wall', 'queries', 'rows', 'scanned', 'buffers'):
+            if key not in result or key not in old:
+                continue
+            if result[key] > old[key] * (1 + threshold):
+                regressions.append((result['scenario'], result['phase'], key,
+                        old[key], result[key]))
+    return regressions
+
+
+def import_time():
+    'Return the seconds taken to import the module in a new interpreter'
+    package = __name__.rsplit('.', 1)[0]
+    output = subprocess.check_output([sys.executable, '-c',
+            _IMPORT_SCRIPT % package])
+    return float(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database')
+    parser.add_argument('-u', '--user', dest='user', default='admin')
+    parser.add_argument('--sale-template', dest='template', type=int)
+    parser.add_argument('--history', dest='history', type=int, nargs='*',
+        default=HISTORY_SIZES)
+    parser.add_argument('--lines', dest='lines', type=int, nargs='*',
+        default=SALE_SIZES)
+    parser.add_argument('-o', '--output', dest='output')
+    parser.add_argument('--compare', dest='compare')
+    parser.add_argument('--import-budget', dest='import_budget', type=float,
+        nargs='?', const=IMPORT_BUDGET)
+    options = parser.parse_args(argv)
+
+    if options.import_budget is not None:
+        seconds = import_time()
+        sys.stdout.write('import time: %.3fs (budget %.3fs)\n'
+            % (seconds, options.import_budget))
+        if seconds > options.import_budget:
+            return 1
+        if not options.database:
+            return 0
+    if not options.database or not options.template:
+        parser.error('--database and --sale-template are required')
+
+    if options.config:
+        config.update_etc(options.config)
+    Pool(options.database).init()
+
+    results = []
+    with Transaction().start(options.database, 0) as transaction:
+        pool = Pool()
+        User = pool.get('res.user')
+        Sale = pool.get('sale.sale')
+        user, = User.search([('login', '=', options.user)])
+        with transaction.set_user(user.id), \
+                transaction.set_context(User.get_preferences(
+                        context_only=True)):
+            template = Sale(options.template)
+            for history in options.history:
+                for size in options.lines:
+                    for advance in (False, True):
+                        run_scenario(template, history, size, advance,
+                            results)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            sys.stderr.write('%s %s %s: %s -> %s\n' % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
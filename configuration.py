@@ -0,0 +1,118 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+
+__all__ = ['Configuration', 'Statement', 'Journal', 'Period']
+__metaclass__ = PoolMeta
+
+
+def _clear_payment_cache():
+    Configuration = Pool().get('sale.configuration')
+    Configuration._payment_cache.clear()
+
+
+class Configuration:
+    __name__ = 'sale.configuration'
+
+    _payment_cache = Cache('sale_configuration.payment', context=False)
+
+    @classmethod
+    def get_payment_config(cls, company, date, journal=None):
+        '''
+        Return a dictionary with the ids of the payment configuration:
+        draft statements of the statement journal, their tipo_pago, the
+        revenue journal and the period of the date.
+        '''
+        pool = Pool()
+        Statement = pool.get('account.statement')
+        Journal = pool.get('account.journal')
+        Period = pool.get('account.period')
+
+        key = (journal.id if journal else None, company.id, date)
+        config = cls._payment_cache.get(key)
+        if config is not None:
+            return config
+
+        config = {
+            'statements': [],
+            'tipo_p': None,
+            }
+        if journal:
+            statements = Statement.search([
+                    ('journal', '=', journal.id),
+                    ('state', '=', 'draft'),
+                    ], order=[('date', 'DESC')])
+            config['statements'] = [s.id for s in statements]
+            if statements:
+                config['tipo_p'] = statements[-1].tipo_pago
+
+        revenue_journals = Journal.search([('type', '=', 'revenue')])
+        config['revenue_journal'] = (revenue_journals[-1].id
+            if revenue_journals else None)
+        config['period'] = Period.find(company.id, date=date,
+            exception=False)
+
+        cls._payment_cache.set(key, config)
+        return config
+
+
+class Statement:
+    __name__ = 'account.statement'
+
+    @classmethod
+    def create(cls, vlist):
+        statements = super(Statement, cls).create(vlist)
+        _clear_payment_cache()
+        return statements
+
+    @classmethod
+    def write(cls, *args):
+        super(Statement, cls).write(*args)
+        _clear_payment_cache()
+
+    @classmethod
+    def delete(cls, statements):
+        super(Statement, cls).delete(statements)
+        _clear_payment_cache()
+
+
+class Journal:
+    __name__ = 'account.journal'
+
+    @classmethod
+    def create(cls, vlist):
+        journals = super(Journal, cls).create(vlist)
+        _clear_payment_cache()
+        return journals
+
+    @classmethod
+    def write(cls, *args):
+        super(Journal, cls).write(*args)
+        _clear_payment_cache()
+
+    @classmethod
+    def delete(cls, journals):
+        super(Journal, cls).delete(journals)
+        _clear_payment_cache()
+
+
+class Period:
+    __name__ = 'account.period'
+
+    @classmethod
+    def create(cls, vlist):
+        periods = super(Period, cls).create(vlist)
+        _clear_payment_cache()
+        return periods
+
+    @classmethod
+    def write(cls, *args):
+        super(Period, cls).write(*args)
+        _clear_payment_cache()
+
+    @classmethod
+    def delete(cls, periods):
+        super(Period, cls).delete(periods)
+        _clear_payment_cache()
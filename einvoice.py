@@ -0,0 +1,390 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from datetime import datetime, timedelta
+import logging
+import multiprocessing
+from multiprocessing.dummy import Pool as ThreadPool
+from sql import For, Null
+from trytond.config import config
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond import backend
+
+__all__ = ['EInvoiceJob', 'Invoice']
+__metaclass__ = PoolMeta
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+BACKOFF = 60
+MAX_BACKOFF = 6 * 60 * 60
+BATCH_SIZE = 50
+LOTE_SIZE = 50
+# Database connections inherited from the parent by a lote worker
+_inherited = {}
+
+
+def _build_lote(args):
+    '''
+    Build and sign the documents of the invoices in a new transaction.
+    Run by the workers of EInvoiceJob.process_lote, outside of the
+    transaction of the caller.
+    Return a list of (invoice id, error) with error None on success.
+    '''
+    database_name, user, context, invoice_ids = args
+    results = []
+    with Transaction().start(database_name, user,
+            context=context) as transaction:
+        pool = Pool()
+        EInvoiceJob = pool.get('sale.einvoice.job')
+        Invoice = pool.get('account.invoice')
+        steps = EInvoiceJob._get_lote_steps()
+        for invoice in Invoice.browse(invoice_ids):
+            try:
+                for step in steps:
+                    getattr(invoice, step)()
+            except Exception as exception:
+                transaction.cursor.rollback()
+                results.append((invoice.id, unicode(exception)))
+            else:
+                transaction.cursor.commit()
+                results.append((invoice.id, None))
+    return results
+
+
+def _init_worker():
+    '''
+    Reset the state inherited from the parent process: its transaction and
+    its database connections. The connections are kept referenced so they
+    are not closed under the parent.
+    '''
+    Transaction().__dict__.clear()
+    databases = backend.get('Database')._databases
+    _inherited.update(databases)
+    databases.clear()
+
+
+STATES = [
+    (None, ''),
+    ('pending', 'Pendiente'),
+    ('done', 'Enviada'),
+    ('failed', 'Fallida'),
+    ]
+
+
+class EInvoiceJob(ModelSQL):
+    'Electronic Invoice Job'
+    __name__ = 'sale.einvoice.job'
+    _rec_name = 'invoice'
+
+    invoice = fields.Many2One('account.invoice', 'Factura', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    state = fields.Selection(STATES[1:], 'Estado', required=True,
+        select=True, readonly=True)
+    attempts = fields.Integer('Intentos', readonly=True)
+    next_try = fields.DateTime('Siguiente intento', select=True,
+        readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EInvoiceJob, cls).__setup__()
+        cls._sql_constraints += [
+            ('invoice_uniq', 'UNIQUE(invoice)',
+                'Solo puede existir un envio por factura.'),
+            ]
+        cls._order.insert(0, ('next_try', 'ASC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def default_next_try():
+        return datetime.now()
+
+    @classmethod
+    def enqueue(cls, invoices):
+        '''
+        Queue the electronic invoice generation of the invoices.
+        Invoices that already have a job are not queued twice, failed jobs
+        are queued again. The invoices already marked as pending are not
+        written.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        invoice_ids = list(set(i.id for i in invoices))
+        if not invoice_ids:
+            return
+        jobs = cls.search([
+                ('invoice', 'in', invoice_ids),
+                ])
+        queued = set(j.invoice.id for j in jobs)
+        failed = [j for j in jobs if j.state == 'failed']
+        if failed:
+            cls.write(failed, {
+                    'state': 'pending',
+                    'attempts': 0,
+                    'next_try': datetime.now(),
+                    })
+        to_queue = [i for i in invoice_ids if i not in queued]
+        if to_queue:
+            cls.create([{'invoice': i} for i in to_queue])
+        to_queue += [j.invoice.id for j in failed]
+        pending = set(i.id for i in invoices
+            if i.einvoice_state == 'pending')
+        to_write = [i for i in to_queue if i not in pending]
+        if to_write:
+            Invoice.write(Invoice.browse(to_write), {
+                    'einvoice_state': 'pending',
+                    })
+
+    @staticmethod
+    def _get_steps():
+        'Return the invoice methods that generate and send the document'
+        return [
+            'get_invoice_element',
+            'get_tax_element',
+            'generate_xml_invoice',
+            'get_detail_element',
+            'action_generate_invoice',
+            'connect_db',
+            ]
+
+    @classmethod
+    def _get_lote_steps(cls):
+        'Return the invoice methods that generate and sign the document'
+        return cls._get_steps()[:-1]
+
+    def send(self):
+        for step in self._get_steps():
+            getattr(self.invoice, step)()
+
+    def _lock(self):
+        'Lock the job row, return False if another worker holds it'
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        if backend.name() != 'postgresql':
+            return True
+        cursor = Transaction().cursor
+        table = self.__table__()
+        try:
+            cursor.execute(*table.select(table.id,
+                    where=table.id == self.id,
+                    for_=For('UPDATE', nowait=True)))
+        except DatabaseOperationalError:
+            cursor.rollback()
+            return False
+        return True
+
+    @classmethod
+    def process(cls, limit=BATCH_SIZE):
+        '''
+        Run the pending jobs whose next try is due.
+        Each job is committed on its own so a failing invoice does not
+        cancel the others; several workers can share the queue.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        cursor = Transaction().cursor
+
+        jobs = cls.search([
+                ('state', '=', 'pending'),
+                ('next_try', '<=', datetime.now()),
+                ], limit=limit)
+        for job in cls.browse([j.id for j in jobs]):
+            if not job._lock():
+                continue
+            try:
+                job.send()
+            except Exception as exception:
+                cursor.rollback()
+                job = cls(job.id)
+                cls._failed(job, exception)
+            else:
+                cls.write([job], {
+                        'state': 'done',
+                        'attempts': job.attempts + 1,
+                        'error': None,
+                        })
+                Invoice.write([job.invoice], {
+                        'einvoice_state': 'done',
+                        })
+            cursor.commit()
+
+    @classmethod
+    def get_lote_invoices(cls, shops):
+        '''
+        Return the ids of the posted invoices of the sales of the shops that
+        have no electronic document or whose document failed. The pending
+        invoices that are not queued were left by a lote run that stopped.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Sale = pool.get('sale.sale')
+        SaleInvoice = pool.get('sale.sale-account.invoice')
+        cursor = Transaction().cursor
+        invoice = Invoice.__table__()
+        sale = Sale.__table__()
+        sale_invoice = SaleInvoice.__table__()
+        job = cls.__table__()
+
+        cursor.execute(*invoice.join(sale_invoice,
+                condition=sale_invoice.invoice == invoice.id
+                ).join(sale, condition=sale_invoice.sale == sale.id
+                ).join(job, 'LEFT', condition=job.invoice == invoice.id
+                ).select(invoice.id,
+                where=sale.shop.in_([s.id for s in shops])
+                & ((sale.fisic_invoice == Null)
+                    | (sale.fisic_invoice == False))
+                & (invoice.type == 'out_invoice')
+                & invoice.state.in_(['posted', 'paid'])
+                & ((invoice.einvoice_state == Null)
+                    | (invoice.einvoice_state == 'failed')
+                    | ((invoice.einvoice_state == 'pending')
+                        & (job.id == Null))),
+                group_by=invoice.id,
+                order_by=invoice.id.asc))
+        return [i for i, in cursor.fetchall()]
+
+    @classmethod
+    def submit_lote(cls, invoices):
+        '''
+        Submit the signed documents of the invoices to the tax authority.
+        Return a dictionary with the error of each invoice, None on success.
+        '''
+        submit = cls._get_steps()[-1]
+        errors = {}
+        for invoice in invoices:
+            try:
+                getattr(invoice, submit)()
+            except Exception as exception:
+                errors[invoice.id] = unicode(exception)
+            else:
+                errors[invoice.id] = None
+        return errors
+
+    @classmethod
+    def process_lote(cls, shops=None, size=None, processes=None):
+        '''
+        Generate the electronic documents of the lote shops.
+        The documents are built and signed in parallel by a pool of
+        processes, one batch of size invoices per task, then submitted by
+        batches. The state of an invoice is only written when its batch is
+        submitted, the invoices of a run that stops before are selected
+        again by the next one.
+        Return a list of (invoice id, error) with error None on success.
+        '''
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Invoice = pool.get('account.invoice')
+        transaction = Transaction()
+
+        if shops is None:
+            shops = Shop.search([('lote', '=', True)])
+        if size is None:
+            size = config.getint('sale_payment', 'lote_size',
+                default=LOTE_SIZE)
+        if processes is None:
+            processes = config.getint('sale_payment', 'lote_processes',
+                default=multiprocessing.cpu_count())
+        invoice_ids = cls.get_lote_invoices(shops)
+        if not invoice_ids:
+            return []
+        # the workers must see the changes of the transaction
+        transaction.cursor.commit()
+
+        tasks = [(transaction.cursor.database_name, transaction.user,
+                transaction.context, invoice_ids[i:i + size])
+            for i in range(0, len(invoice_ids), size)]
+        if processes > 1:
+            workers = multiprocessing.Pool(processes, _init_worker)
+        else:
+            # a thread starts with no transaction
+            workers = ThreadPool(1)
+        try:
+            built = workers.map(_build_lote, tasks)
+        finally:
+            workers.close()
+            workers.join()
+
+        results = []
+        for batch in built:
+            errors = dict((i, e) for i, e in batch if e)
+            signed = Invoice.browse([i for i, e in batch if not e])
+            if signed:
+                errors.update(cls.submit_lote(signed))
+            for invoice_id, error in sorted(errors.iteritems()):
+                if error:
+                    logger.warning('Electronic invoice %s failed: %s',
+                        invoice_id, error)
+                results.append((invoice_id, error))
+            failed = [i for i, e in errors.iteritems() if e]
+            if failed:
+                Invoice.write(Invoice.browse(failed), {
+                        'einvoice_state': 'failed',
+                        })
+            done = [i for i, e in errors.iteritems() if not e]
+            if done:
+                Invoice.write(Invoice.browse(done), {
+                        'einvoice_state': 'done',
+                        })
+            transaction.cursor.commit()
+        return results
+
+    @classmethod
+    def _failed(cls, job, exception):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        attempts = job.attempts + 1
+        logger.warning('Electronic invoice %s failed (attempt %s): %s',
+            job.invoice.id, attempts, exception)
+        values = {
+            'attempts': attempts,
+            'error': unicode(exception),
+            }
+        if attempts >= MAX_ATTEMPTS:
+            values['state'] = 'failed'
+            Invoice.write([job.invoice], {
+                    'einvoice_state': 'failed',
+                    })
+        else:
+            delay = min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+            values['next_try'] = datetime.now() + timedelta(seconds=delay)
+        cls.write([job], values)
+
+
+class Invoice:
+    __name__ = 'account.invoice'
+
+    einvoice_state = fields.Selection(STATES, 'Estado Factura Electronica',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Invoice, cls).__setup__()
+        cls._check_modify_exclude = (list(cls._check_modify_exclude)
+            + ['einvoice_state'])
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        created = not table.column_exist('einvoice_state')
+        sql_table = cls.__table__()
+
+        super(Invoice, cls).__register__(module_name)
+
+        # The invoices that exist were already sent or generated by hand,
+        # they must not be sent again by the lote processing
+        if created:
+            cursor.execute(*sql_table.update([sql_table.einvoice_state],
+                    ['done'],
+                    where=sql_table.state.in_(['posted', 'paid'])))
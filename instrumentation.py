@@ -0,0 +1,109 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Timing of the payment phases.
+
+Enable it in the trytond configuration file:
+
+    [sale_payment]
+    instrumentation = True
+
+Each phase is logged by the
+trytond.modules.nodux_sale_payment_advanced_payment.instrumentation logger
+as a JSON object with its duration, SQL statements and rows read.
+'''
+import json
+import logging
+import time
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['QueryCounter', 'span']
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    return config.getboolean('sale_payment', 'instrumentation',
+        default=False)
+
+
+class QueryCounter(object):
+    'Count the SQL statements and rows read on the transaction cursor'
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self._cursor = None
+        self._previous = None
+
+    def __enter__(self):
+        self._cursor = cursor = Transaction().cursor
+        # keep the execute of an enclosing counter to restore it
+        self._previous = cursor.__dict__.get('execute')
+        execute = cursor.execute
+
+        def counted_execute(*args, **kwargs):
+            result = execute(*args, **kwargs)
+            self.queries += 1
+            self.rows += max(getattr(cursor, 'rowcount', 0) or 0, 0)
+            return result
+        cursor.execute = counted_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._previous is None:
+            del self._cursor.execute
+        else:
+            self._cursor.execute = self._previous
+        self._cursor = self._previous = None
+
+
+class Span(object):
+    'Log the duration and SQL statements of a payment phase'
+
+    def __init__(self, phase, **info):
+        self.phase = phase
+        self.info = info
+        self._start = None
+        self._counter = QueryCounter()
+
+    def __enter__(self):
+        self._start = time.time()
+        self._counter.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._counter.__exit__(type, value, traceback)
+        record = dict(self.info)
+        record.update({
+                'phase': self.phase,
+                'duration': time.time() - self._start,
+                'queries': self._counter.queries,
+                'rows': self._counter.rows,
+                'failed': type is not None,
+                })
+        logger.info(json.dumps(record, default=str, sort_keys=True))
+
+
+class _NullSpan(object):
+
+    @property
+    def info(self):
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(phase, **info):
+    'Return a context manager that logs the phase when enabled'
+    if not enabled():
+        return _NULL_SPAN
+    return Span(phase, **info)
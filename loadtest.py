@@ -0,0 +1,456 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Load test of the payment wizard with concurrent sale devices.
+
+Run on a local database where this module is installed, the company has a
+chart of accounts and an open fiscal year and each sale device has a journal
+with a draft statement with tipo_pago:
+
+    python -m trytond.modules.nodux_sale_payment_advanced_payment.loadtest \\
+        -c trytond.conf -d DATABASE --sale-template SALE_ID --devices 20 \\
+        --mix efectivo=50,tarjeta=20,cheque=10,deposito=10,anticipo=10
+
+SALE_ID is a draft sale with goods in stock, it is copied for each payment.
+Each device runs in its own thread and transaction, pays --payments sales
+(default_start then transition_pay_) and commits each payment. The anticipo
+payments share one party and its advances.
+
+The result reports the throughput, the latency percentiles, the payments
+rejected by a user error (like an advance used by another device), the
+serialization failures and, on PostgreSQL, the lock waits sampled every
+LOCK_INTERVAL. At the end the allocations of the shared advances are checked:
+the advance lines allocated for more than their amount, lost updates between
+devices, are listed in overallocated and make the run fail.
+
+With --check-consume two payments use the whole advance of a new party at
+the same time instead: the one that waits for the lock of the other must fail
+with a serialization error, otherwise the check fails.
+'''
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+from decimal import Decimal
+
+from sql.aggregate import Sum
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .benchmark import _sale
+
+PAYMENTS = 10
+MIX = 'efectivo=50,tarjeta=20,cheque=10,deposito=10,anticipo=10'
+ADVANCE_AMOUNT = Decimal('1000000.00')
+LOCK_INTERVAL = 0.1
+
+
+def parse_mix(value):
+    'Return a list of (payment type, weight) from type=weight,...'
+    mix = []
+    for item in value.split(','):
+        name, weight = item.split('=')
+        mix.append((name.strip(), int(weight)))
+    return mix
+
+
+def percentile(values, percent):
+    'Return the nearest-rank percentile of the sorted values'
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def _advance_party(name='loadtest-advance', amount=ADVANCE_AMOUNT):
+    'Return the party shared by the anticipo payments, create it if needed'
+    pool = Pool()
+    Party = pool.get('party.party')
+    Move = pool.get('account.move')
+    Period = pool.get('account.period')
+    Date = pool.get('ir.date')
+    Configuration = pool.get('sale.configuration')
+    User = pool.get('res.user')
+
+    parties = Party.search([('name', '=', name)])
+    if parties:
+        return parties[0]
+    party, = Party.create([{
+                'name': name,
+                'addresses': [('create', [{}])],
+                }])
+
+    company = User(Transaction().user).company
+    today = Date.today()
+    config = Configuration.get_payment_config(company, today)
+    move, = Move.create([{
+                'period': Period.find(company.id, date=today),
+                'journal': config['revenue_journal'],
+                'date': today,
+                'lines': [('create', [{
+                                'party': party.id,
+                                'account': party.account_receivable.id,
+                                'debit': Decimal(0),
+                                'credit': amount,
+                                }, {
+                                'account': party.account_payable.id,
+                                'debit': amount,
+                                'credit': Decimal(0),
+                                }])],
+                }])
+    Move.post([move])
+    return party
+
+
+def _set_payment(payment, kind, today):
+    'Fill the payment form for the payment type'
+    start = payment.start
+    if kind == 'anticipo':
+        start.utilizar_anticipo = True
+        for name, value in start.on_change_utilizar_anticipo().iteritems():
+            setattr(start, name, value)
+        return
+    start.tipo_p = kind
+    if kind == 'efectivo':
+        start.recibido = start.payment_amount
+        start.cambio_cliente = Decimal(0)
+    elif kind == 'tarjeta':
+        start.numero_tarjeta = '0000'
+        start.lote = '1'
+    elif kind == 'cheque':
+        start.numero_cheque = '1'
+        start.numero_cuenta = '1'
+        start.titular = start.party.name
+        start.fecha_deposito = today
+    elif kind == 'deposito':
+        start.numero_deposito = '1'
+        start.numero_cuenta_deposito = '1'
+        start.fecha_deposito = today
+
+
+class Terminal(threading.Thread):
+    'Pay sales from a sale device in its own transactions'
+
+    def __init__(self, options, device_id, party_id, mix, results):
+        super(Terminal, self).__init__(name='device-%s' % device_id)
+        self.options = options
+        self.device_id = device_id
+        self.party_id = party_id
+        self.mix = mix
+        self.results = results
+        self.random = random.Random(device_id)
+
+    def _kind(self):
+        value = self.random.uniform(0, sum(w for _, w in self.mix))
+        for kind, weight in self.mix:
+            value -= weight
+            if value <= 0:
+                return kind
+        return self.mix[-1][0]
+
+    def run(self):
+        for _ in range(self.options.payments):
+            self.pay(self._kind())
+
+    def pay(self, kind):
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        options = self.options
+        with Transaction().start(options.database, options.user_id,
+                context=options.context) as transaction:
+            pool = Pool()
+            Sale = pool.get('sale.sale')
+            Party = pool.get('party.party')
+            Date = pool.get('ir.date')
+            Warning_ = pool.get('res.user.warning')
+            WizardSalePayment = pool.get('sale.payment', type='wizard')
+
+            start = None
+            result = 'ok'
+            try:
+                template = Sale(options.template)
+                party = (Party(self.party_id) if kind == 'anticipo'
+                    else template.party)
+                sale = _sale(template, party, 1)
+                Sale.write([sale], {'sale_device': self.device_id})
+                # a payment lower than the total asks for a confirmation
+                Warning_.create([{
+                            'user': options.user_id,
+                            'name': 'not_credit%s' % sale.id,
+                            'always': False,
+                            }])
+                transaction.cursor.commit()
+
+                start = time.time()
+                with transaction.set_context(active_id=sale.id):
+                    session_id, _, _ = WizardSalePayment.create()
+                    payment = WizardSalePayment(session_id)
+                    for name, value in payment.default_start(
+                            None).iteritems():
+                        setattr(payment.start, name, value)
+                    _set_payment(payment, kind, Date.today())
+                    payment.transition_pay_()
+                    WizardSalePayment.delete(session_id)
+                transaction.cursor.commit()
+            except DatabaseOperationalError:
+                result = 'serialization'
+            except UserError:
+                result = 'rejected'
+            except Exception:
+                result = 'error'
+            if result != 'ok':
+                transaction.cursor.rollback()
+            self.results.append({
+                    'device': self.device_id,
+                    'kind': kind,
+                    'result': result,
+                    'latency': time.time() - start if start else None,
+                    })
+
+
+class LockMonitor(threading.Thread):
+    'Sample the lock waits of the database'
+
+    def __init__(self, database):
+        super(LockMonitor, self).__init__(name='lock-monitor')
+        self.database = database
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        with Transaction().start(self.database, 0) as transaction:
+            cursor = transaction.cursor
+            while not self.stopped.is_set():
+                cursor.execute('SELECT COUNT(*) FROM pg_locks '
+                    'WHERE NOT granted')
+                self.samples.append(cursor.fetchone()[0])
+                cursor.rollback()
+                self.stopped.wait(LOCK_INTERVAL)
+
+
+def check_allocations(party_id):
+    '''
+    Return the ids of the advance lines of the party allocated for more
+    than their amount, a lost update between concurrent payments
+    '''
+    pool = Pool()
+    Allocation = pool.get('sale.advance.allocation')
+    MoveLine = pool.get('account.move.line')
+    cursor = Transaction().cursor
+    allocation = Allocation.__table__()
+    line = MoveLine.__table__()
+
+    cursor.execute(*allocation.join(line,
+            condition=allocation.advance == line.id
+            ).select(allocation.advance,
+            where=allocation.party == party_id,
+            group_by=[allocation.advance, line.credit],
+            having=Sum(allocation.amount) > line.credit))
+    return [a for a, in cursor.fetchall()]
+
+
+def _consume(options, sale_id, read, locking, consumed=None):
+    '''
+    Use the whole advance of the party of the sale like the anticipo
+    payment: read the advance and set read, wait for locking to lock and
+    consume it, set consumed and commit LOCK_INTERVAL later.
+    Return ok, rejected, serialization or the unexpected error.
+    '''
+    DatabaseOperationalError = backend.get('DatabaseOperationalError')
+    with Transaction().start(options.database, options.user_id,
+            context=options.context) as transaction:
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        AdvanceLine = pool.get('sale.advance.line')
+
+        result = 'ok'
+        try:
+            sale = Sale(sale_id)
+            advances = AdvanceLine.get_advances(sale.party, sale.company)
+            lines = [a.line for a in advances]
+            amount = sum((a.amount for a in advances), Decimal(0))
+            read.set()
+            locking.wait()
+            AdvanceLine.check_available(sale.party, lines, amount)
+            AdvanceLine.consume(sale, None, lines, amount)
+            if consumed:
+                consumed.set()
+                # leave the other payment waiting for the lock
+                time.sleep(LOCK_INTERVAL)
+            transaction.cursor.commit()
+        except DatabaseOperationalError:
+            result = 'serialization'
+        except UserError:
+            result = 'rejected'
+        except Exception as exception:
+            result = repr(exception)
+        finally:
+            read.set()
+            if consumed:
+                consumed.set()
+        if result != 'ok':
+            transaction.cursor.rollback()
+        return result
+
+
+def check_concurrent_consume(options):
+    '''
+    Pay two sales with the whole advance of a new party at the same time.
+    Both payments read the open advance, the first one consumes it and
+    commits while the second one waits for the lock of the same advance
+    line: the second one must fail with a serialization error.
+    Return the results of the first and the second payment.
+    '''
+    with Transaction().start(options.database, options.user_id,
+            context=options.context) as transaction:
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Date = pool.get('ir.date')
+        template = Sale(options.template)
+        party = _advance_party(name='loadtest-consume-%s' % time.time(),
+            amount=Decimal('10.00'))
+        sales = [_sale(template, party, 1) for _ in range(2)]
+        Sale.write(sales, {'sale_date': Date.today()})
+        sale_ids = [s.id for s in sales]
+        transaction.cursor.commit()
+
+    first_read = threading.Event()
+    second_read = threading.Event()
+    consumed = threading.Event()
+    results = {}
+
+    def first():
+        results['first'] = _consume(options, sale_ids[0], first_read,
+            second_read, consumed)
+
+    def second():
+        first_read.wait()
+        results['second'] = _consume(options, sale_ids[1], second_read,
+            consumed)
+
+    threads = [threading.Thread(target=first),
+        threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results['first'], results['second']
+
+
+def summary(results, duration, lock_samples, overallocated):
+    latencies = sorted(r['latency'] for r in results if r['result'] == 'ok')
+    counts = {}
+    kinds = {}
+    for result in results:
+        counts[result['result']] = counts.get(result['result'], 0) + 1
+        kind = kinds.setdefault(result['kind'], {})
+        kind[result['result']] = kind.get(result['result'], 0) + 1
+    return {
+        'payments': len(results),
+        'duration': duration,
+        'throughput': len(latencies) / duration if duration else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'ok': counts.get('ok', 0),
+        'rejected': counts.get('rejected', 0),
+        'serialization_failures': counts.get('serialization', 0),
+        'errors': counts.get('error', 0),
+        'lock_waits': sum(1 for s in lock_samples if s),
+        'max_lock_waits': max(lock_samples) if lock_samples else None,
+        'kinds': kinds,
+        'overallocated': overallocated,
+        }
+
+
+def set_user(options):
+    'Set the user id and its context on the options'
+    with Transaction().start(options.database, 0):
+        pool = Pool()
+        User = pool.get('res.user')
+        user, = User.search([('login', '=', options.user)])
+        options.user_id = user.id
+        with Transaction().set_user(user.id):
+            options.context = User.get_preferences(context_only=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='user', default='admin')
+    parser.add_argument('--sale-template', dest='template', type=int,
+        required=True)
+    parser.add_argument('--devices', dest='devices', type=int, default=1)
+    parser.add_argument('--payments', dest='payments', type=int,
+        default=PAYMENTS)
+    parser.add_argument('--mix', dest='mix', default=MIX)
+    parser.add_argument('--check-consume', dest='check_consume',
+        action='store_true')
+    parser.add_argument('-o', '--output', dest='output')
+    options = parser.parse_args(argv)
+    mix = parse_mix(options.mix)
+
+    if options.config:
+        config.update_etc(options.config)
+    Pool(options.database).init()
+    set_user(options)
+
+    if options.check_consume:
+        first, second = check_concurrent_consume(options)
+        sys.stdout.write(json.dumps({'first': first, 'second': second},
+                sort_keys=True) + '\n')
+        return 0 if (first, second) == ('ok', 'serialization') else 1
+
+    with Transaction().start(options.database, options.user_id,
+            context=options.context) as transaction:
+        pool = Pool()
+        SaleDevice = pool.get('sale.device')
+        devices = SaleDevice.search([('journal', '!=', None)],
+            limit=options.devices)
+        if len(devices) < options.devices:
+            parser.error('only %s sale devices with a journal'
+                % len(devices))
+        party = _advance_party()
+        transaction.cursor.commit()
+
+    results = []
+    threads = [Terminal(options, d.id, party.id, mix, results)
+        for d in devices]
+    monitor = None
+    if backend.name() == 'postgresql':
+        monitor = LockMonitor(options.database)
+        monitor.start()
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    if monitor:
+        monitor.stopped.set()
+        monitor.join()
+
+    with Transaction().start(options.database, 0):
+        overallocated = check_allocations(party.id)
+
+    output = json.dumps(summary(results, duration,
+            monitor.samples if monitor else [], overallocated), indent=2,
+        sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+    return 1 if overallocated else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
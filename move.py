@@ -1,11 +1,11 @@
 #This file is part of the nodux_account_voucher_ec module for Tryton.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
-from decimal import Decimal
-from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond import backend
 
-__all__ = ['Move', 'Line']
+__all__ = ['Move', 'Line', 'Reconciliation']
 __metaclass__ = PoolMeta
 
 
@@ -13,19 +13,75 @@ class Move:
     __name__ = 'account.move'
 
     @classmethod
-    def __setup__(cls):
-        super(Move, cls).__setup__()
-        cls._check_modify_exclude = ['state', 'description', 'lines']
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        super(Move, cls).__register__(module_name)
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action('origin', 'add')
 
     @classmethod
     def _get_origin(cls):
         return super(Move, cls)._get_origin() + ['sale.sale']
 
+    @classmethod
+    def validate_move(cls, moves):
+        pool = Pool()
+        AdvanceLine = pool.get('sale.advance.line')
+        super(Move, cls).validate_move(moves)
+        # line states are updated with SQL so the ledger must be refreshed
+        AdvanceLine.update_lines([l for m in moves for l in m.lines])
+
 
 class Line:
     __name__ = 'account.move.line'
 
     @classmethod
-    def __setup__(cls):
-        super(Line, cls).__setup__()
-        cls._check_modify_exclude = {'reconciliation', 'debit', 'credit'}
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        super(Line, cls).__register__(module_name)
+
+        # Partial index of the open advances of the parties
+        index = cls._table + '_open_advance_index'
+        where = ('reconciliation IS NULL AND maturity_date IS NULL '
+            'AND state = \'valid\' AND credit > 0')
+        if backend.name() == 'postgresql':
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index,))
+            if not cursor.fetchone():
+                cursor.execute('CREATE INDEX "' + index + '" ON "'
+                    + cls._table + '" (party, account) WHERE ' + where)
+        elif backend.name() == 'sqlite':
+            cursor.execute('CREATE INDEX IF NOT EXISTS "' + index + '" ON "'
+                + cls._table + '" (party, account) WHERE ' + where)
+        else:
+            table = TableHandler(cursor, cls, module_name)
+            table.index_action(['party', 'account'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        AdvanceLine = pool.get('sale.advance.line')
+        lines = super(Line, cls).create(vlist)
+        AdvanceLine.update_lines(lines)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        AdvanceLine = pool.get('sale.advance.line')
+        super(Line, cls).write(*args)
+        AdvanceLine.update_lines(sum(args[0::2], []))
+
+
+class Reconciliation:
+    __name__ = 'account.move.reconciliation'
+
+    @classmethod
+    def delete(cls, reconciliations):
+        pool = Pool()
+        AdvanceLine = pool.get('sale.advance.line')
+        lines = [l for r in reconciliations for l in r.lines]
+        super(Reconciliation, cls).delete(reconciliations)
+        AdvanceLine.update_lines(lines)
@@ -2,33 +2,314 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 #! -*- coding: utf8 -*-
+from contextlib import contextmanager
 from decimal import Decimal
-from trytond.model import ModelView, fields, ModelSQL, Workflow
+import time
+from sql import Null
+from sql.aggregate import Sum
+from trytond.model import ModelView, fields
 from trytond.pool import PoolMeta, Pool
-from trytond.pyson import Bool, Eval, Not, If, PYSONEncoder, Id
+from trytond.pyson import Eval
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, StateTransition, Button, StateAction
 from trytond import backend
-from datetime import datetime,timedelta
-from dateutil.relativedelta import relativedelta
-from itertools import groupby, chain
-from functools import partial
-from trytond.report import Report
-from trytond.transaction import Transaction
-import os
-
-conversor = None
-try:
-    from numword import numword_es
-    conversor = numword_es.NumWordES()
-except:
-    print("Warning: Does not possible import numword module!")
-    print("Please install it...!")
+from trytond.cache import Cache
+from trytond.exceptions import UserError, UserWarning
+from .instrumentation import span
 
-__all__ = [ 'SalePaymentForm',  'WizardSalePayment']
+__all__ = [ 'Sale', 'SalePaymentForm',  'WizardSalePayment', 'SaleBatchPaymentStart',
+    'SaleBatchPaymentResult', 'WizardSaleBatchPayment']
 __metaclass__ = PoolMeta
 _ZERO = Decimal('0.0')
 PRODUCT_TYPES = ['goods']
+# Seconds a warehouse quantity stays valid for the payment stock check
+STOCK_CACHE_TTL = 30
+
+
+@contextmanager
+def savepoint(name):
+    '''
+    Run the block in a savepoint of the transaction, on error the changes
+    of the block are rolled back and the error is raised again
+    '''
+    cursor = Transaction().cursor
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        # the cached values may come from the rolled back changes
+        cursor.cache.clear()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+def _error_message(exception):
+    if isinstance(exception, UserError):
+        return exception.message
+    return unicode(exception)
+
+
+class Sale:
+    __name__ = 'sale.sale'
+    origin_sale = fields.Many2One('sale.sale', 'Venta original', select=True,
+        readonly=True, help='La venta de la que proviene esta devolucion.')
+    cumulative_paid = fields.Numeric('Pagado acumulado', digits=(16, 2),
+        readonly=True, states={
+            'invisible': ~Eval('acumulativo', False),
+            }, depends=['acumulativo'])
+    cumulative_state = fields.Selection([
+            (None, ''),
+            ('pending', 'Pendiente'),
+            ('paid', 'Pagada'),
+            ('settled', 'Liquidada'),
+            ], 'Estado acumulativo', select=True, readonly=True, states={
+            'invisible': ~Eval('acumulativo', False),
+            }, depends=['acumulativo'])
+    _payment_stock_cache = Cache('sale_sale.payment_stock', context=False)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        migrate_origin = not table.column_exist('origin_sale')
+
+        super(Sale, cls).__register__(module_name)
+
+        if migrate_origin:
+            cls._migrate_origin_sale()
+
+    @classmethod
+    def _migrate_origin_sale(cls):
+        '''
+        Link the existing returns to their sale. A return is linked when
+        exactly one sale with a positive amount shares its description.
+        '''
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        cursor = Transaction().cursor
+        sale = cls.__table__()
+        line = SaleLine.__table__()
+
+        cursor.execute(*line.select(line.sale,
+                Sum(line.quantity * line.unit_price),
+                where=line.type == 'line',
+                group_by=line.sale))
+        amounts = dict(cursor.fetchall())
+        cursor.execute(*sale.select(sale.id, sale.description,
+                where=(sale.description != Null) & (sale.description != '')))
+        descriptions = {}
+        for sale_id, description in cursor.fetchall():
+            originals, returns = descriptions.setdefault(description,
+                ([], []))
+            if (amounts.get(sale_id) or 0) > 0:
+                originals.append(sale_id)
+            else:
+                returns.append(sale_id)
+        for originals, returns in descriptions.itervalues():
+            if len(originals) != 1 or not returns:
+                continue
+            for i in range(0, len(returns), cursor.IN_MAX):
+                cursor.execute(*sale.update([sale.origin_sale],
+                        [originals[0]],
+                        where=sale.id.in_(returns[i:i + cursor.IN_MAX])))
+
+    @classmethod
+    def create(cls, vlist):
+        sales = super(Sale, cls).create(vlist)
+        if not Transaction().context.get('_sale_copy'):
+            cls.link_returns(sales)
+        return sales
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        '''
+        The copies are not returns: they are not linked to the sale of
+        their description
+        '''
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('origin_sale', None)
+        with Transaction().set_context(_sale_copy=True):
+            return super(Sale, cls).copy(sales, default=default)
+
+    @classmethod
+    def link_returns(cls, sales):
+        '''
+        Link the returns to their sale: a sale without a positive amount
+        whose description is the reference of exactly one sale is a return
+        of that sale
+        '''
+        returns = [s for s in sales
+            if s.description and not s.origin_sale
+            and s.total_amount <= _ZERO]
+        if not returns:
+            return
+        originals = {}
+        for sale in cls.search([
+                    ('reference', 'in',
+                        list(set(s.description for s in returns))),
+                    ]):
+            originals.setdefault(sale.reference, []).append(sale)
+        to_write = []
+        for sale in returns:
+            origins = originals.get(sale.description, [])
+            if len(origins) == 1 and origins[0] != sale:
+                to_write.extend(([sale], {'origin_sale': origins[0].id}))
+        if to_write:
+            cls.write(*to_write)
+
+    def get_refund_amount(self):
+        'Return the amount to refund for the return sale'
+        origin = self.origin_sale
+        if not origin or origin.total_amount <= _ZERO:
+            return _ZERO
+        if origin.paid_amount:
+            if origin.paid_amount > _ZERO and origin.state != 'done':
+                return origin.paid_amount * (-1)
+        elif origin.state == 'done':
+            return origin.total_amount * (-1)
+        return _ZERO
+
+    @classmethod
+    def get_payment_quantities(cls, warehouse, products, name):
+        '''
+        Return a dictionary with the quantity of each product in the
+        warehouse. Quantities younger than STOCK_CACHE_TTL are reused.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        now = time.time()
+        quantities = {}
+        missing = []
+        for product in set(products):
+            cached = cls._payment_stock_cache.get(
+                (warehouse.id, name, product.id))
+            if cached is not None and now - cached[0] < STOCK_CACHE_TTL:
+                quantities[product.id] = cached[1]
+            else:
+                missing.append(product)
+        if missing:
+            with Transaction().set_context(locations=[warehouse.id]):
+                computed = Product.get_quantity(missing, name)
+            for product_id, quantity in computed.iteritems():
+                cls._payment_stock_cache.set((warehouse.id, name, product_id),
+                    (now, quantity))
+            quantities.update(computed)
+        return quantities
+
+    @staticmethod
+    def stock_force_allowed():
+        'Return True if the user may sell without enough stock'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+
+        transaction = Transaction()
+        user_id = transaction.user
+        if user_id == 0:
+            user_id = transaction.context.get('user', user_id)
+        if user_id == 0:
+            return True
+        group_id = ModelData.get_id('nodux_sale_payment', 'group_stock_force')
+        with transaction.set_user(user_id):
+            return group_id in User.get_groups()
+
+    def get_lines_without_stock(self):
+        'Return the goods lines of the sale without enough stock'
+        products = [l.product for l in self.lines
+            if l.product and l.product.type in PRODUCT_TYPES]
+        if not products:
+            return []
+        quantities = self.get_payment_quantities(self.warehouse, products,
+            self.get_enough_stock_qty())
+
+        lines = []
+        for line in self.lines:
+            if not line.product or line.product.type not in PRODUCT_TYPES:
+                continue
+            qty = quantities.get(line.product.id, 0)
+            if qty < line.quantity:
+                lines.append(line)
+                quantities[line.product.id] = qty - line.quantity
+        return lines
+
+    @classmethod
+    def update_cumulative(cls, sales):
+        '''
+        Update the amount paid by statement lines of the cumulative sales
+        and mark as paid the ones that reach their total
+        '''
+        pool = Pool()
+        StatementLine = pool.get('account.statement.line')
+        cursor = Transaction().cursor
+        line = StatementLine.__table__()
+
+        sales = [s for s in cls.browse(list(set(s.id for s in sales)))
+            if s.acumulativo and s.cumulative_state != 'settled']
+        sale_ids = [s.id for s in sales]
+        paid = {}
+        for i in range(0, len(sale_ids), cursor.IN_MAX):
+            cursor.execute(*line.select(line.sale, Sum(line.amount),
+                    where=line.sale.in_(sale_ids[i:i + cursor.IN_MAX]),
+                    group_by=line.sale))
+            paid.update(cursor.fetchall())
+
+        to_write = []
+        for sale in sales:
+            amount = Decimal(str(paid.get(sale.id) or 0))
+            state = 'paid' if amount >= sale.total_amount else 'pending'
+            if (amount, state) != (sale.cumulative_paid,
+                    sale.cumulative_state):
+                to_write.extend(([sale], {
+                            'cumulative_paid': amount,
+                            'cumulative_state': state,
+                            }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def settle_cumulative(cls, sales=None):
+        '''
+        Finalize the fully paid cumulative sales: process them, queue their
+        electronic invoices and mark them as settled
+        '''
+        pool = Pool()
+        EInvoiceJob = pool.get('sale.einvoice.job')
+
+        if sales is None:
+            sales = cls.search([
+                    ('cumulative_state', '=', 'paid'),
+                    ])
+        sales = [s for s in sales if s.cumulative_state == 'paid']
+        if not sales:
+            return
+        cls.workflow_to_end([s for s in sales
+                if s.state not in ('done', 'cancel')])
+        invoices = cls.get_payment_invoices(sales)
+        EInvoiceJob.enqueue([i for i in invoices.itervalues() if i])
+        cls.write(*sum((([s], {
+                        'description': s.reference,
+                        'cumulative_state': 'settled',
+                        }) for s in sales), ()))
+
+    @classmethod
+    def get_payment_invoices(cls, sales):
+        '''
+        Return a dictionary with the invoice of each sale id, the most
+        recent one that is not cancelled
+        '''
+        result = {}
+        for sale in cls.browse([s.id for s in sales]):
+            invoices = [i for i in sale.invoices if i.state != 'cancel']
+            result[sale.id] = (max(invoices, key=lambda i: i.id)
+                if invoices else None)
+        return result
+
 
 class SalePaymentForm():
     'Sale Payment Form'
@@ -38,7 +319,8 @@ class SalePaymentForm():
 
     utilizar_anticipo = fields.Boolean('Utilizar anticipo')
 
-    lineas_anticipo = fields.Char('Lineas de Anticipo')
+    lineas_anticipo = fields.Many2Many('account.move.line', None, None,
+        'Lineas de Anticipo', readonly=True)
 
     restante = fields.Numeric('Anticipo restante', readonly = True, states={
         'invisible': ~Eval('utilizar_anticipo', True)
@@ -84,6 +366,11 @@ class WizardSalePayment(Wizard):
                 })
 
     def default_start(self, fields):
+        sale_id = Transaction().context['active_id']
+        with span('default_start', sale=sale_id):
+            return self._default_start(fields)
+
+    def _default_start(self, fields):
         pool = Pool()
         Sale = pool.get('sale.sale')
         User = pool.get('res.user')
@@ -92,59 +379,29 @@ class WizardSalePayment(Wizard):
         user = User(Transaction().user)
         sale_device = sale.sale_device or user.sale_device or False
         Date = pool.get('ir.date')
-        Statement=pool.get('account.statement')
+        Configuration = pool.get('sale.configuration')
 
-        Invoice = pool.get('account.invoice')
-        MoveLine = pool.get('account.move.line')
-        InvoiceAccountMoveLine = pool.get('account.invoice-account.move.line')
+        AdvanceLine = pool.get('sale.advance.line')
         amount_a = Decimal(0.0)
-        account_types = ['receivable']
 
         lines_credits = []
 
-        move_lines = MoveLine.search([
-            ('party', '=', sale.party),
-            ('account.kind', 'in', account_types),
-            ('state', '=', 'valid'),
-            ('reconciliation', '=', None),
-            ('maturity_date', '=', None),
-        ])
-        for line in move_lines:
-            invoice = InvoiceAccountMoveLine.search([
-                ('line', '=', line.id),
-            ])
-            if invoice:
-                continue
-            if line.credit:
-                line_type = 'cr'
-                amount_a = amount_a + line.credit
-                lines_credits.append(str(line.id) +',')
-
-        ModelData = pool.get('ir.model.data')
-        User = pool.get('res.user')
-        Group = pool.get('res.group')
-        origin = str(sale)
-        def in_group():
-
-            group = Group(ModelData.get_id('nodux_sale_payment',
-                    'group_stock_force'))
-            transaction = Transaction()
-            user_id = transaction.user
-            if user_id == 0:
-                user_id = transaction.context.get('user', user_id)
-            if user_id == 0:
-                return True
-            user = User(user_id)
-            return origin and group in user.groups
+        with span('advances', sale=sale.id, party=sale.party.id) as s:
+            advances = AdvanceLine.get_advances(sale.party, sale.company)
+            for advance in advances:
+                amount_a = amount_a + advance.amount
+                lines_credits.append(advance.line.id)
+            s.info['lines'] = len(lines_credits)
 
         if sale_device.journal:
-            statement = Statement.search([('journal', '=', sale_device.journal.id), ('state', '=', 'draft')], order=[('date', 'DESC')])
+            with span('configuration', sale=sale.id):
+                config = Configuration.get_payment_config(sale.company,
+                    Date.today(), journal=sale_device.journal)
         else:
             self.raise_user_error('No se ha definido un libro diario por defecto para %s', sale_device.name)
 
-        if statement :
-            for s in statement:
-                tipo_p = s.tipo_pago
+        if config['statements']:
+            tipo_p = config['tipo_p']
             if tipo_p :
                 pass
             else:
@@ -152,53 +409,29 @@ class WizardSalePayment(Wizard):
         else:
              self.raise_user_error('No ha creado un estado de cuenta para %s ', sale_device.name)
 
-        if not sale.check_enough_stock():
-            return
-
-        Product = Pool().get('product.product')
-
+        with span('stock', sale=sale.id, lines=len(sale.lines)):
+            if not sale.check_enough_stock():
+                return
+            if sale.acumulativo != True:
+                lines = sale.get_lines_without_stock()
 
         if sale.acumulativo == True:
             pass
         else:
-            if sale.lines:
-                # get all products
-                products = []
-                locations = [sale.warehouse.id]
-                for line in sale.lines:
-                    if not line.product or line.product.type not in PRODUCT_TYPES:
-                        continue
-                    if line.product not in products:
-                        products.append(line.product)
-                # get quantity
-                with Transaction().set_context(locations=locations):
-                    quantities = Product.get_quantity(
-                        products,
-                        sale.get_enough_stock_qty(),
-                        )
-
-                # check enough stock
-                for line in sale.lines:
-                    if line.product.type not in PRODUCT_TYPES:
-                        continue
-                    else:
-                        if line.product and line.product.id in quantities:
-                            qty = quantities[line.product.id]
-                        if qty < line.quantity:
-                            if not in_group():
-                                self.raise_user_error('No hay suficiente stock del producto: \n %s \n en la bodega %s', (line.product.name, sale.warehouse.name))
-
-                            line.raise_user_warning('not_enough_stock_%s' % line.id,
-                                   'No hay suficiente stock del producto: "%s"'
-                                'en la bodega "%s", para realizar esta venta.', (line.product.name, sale.warehouse.name))
-                            # update quantities
-                            quantities[line.product.id] = qty - line.quantity
+            if lines and not sale.stock_force_allowed():
+                line = lines[0]
+                self.raise_user_error('No hay suficiente stock del producto: \n %s \n en la bodega %s', (line.product.name, sale.warehouse.name))
+            for line in lines:
+                line.raise_user_warning('not_enough_stock_%s' % line.id,
+                       'No hay suficiente stock del producto: "%s"'
+                    'en la bodega "%s", para realizar esta venta.', (line.product.name, sale.warehouse.name))
 
         if user.id != 0 and not sale_device:
             self.raise_user_error('not_sale_device')
 
-        term_lines = sale.payment_term.compute(sale.total_amount, sale.company.currency,
-            sale.sale_date)
+        with span('payment_term', sale=sale.id):
+            term_lines = sale.payment_term.compute(sale.total_amount, sale.company.currency,
+                sale.sale_date)
         total = sale.total_amount
         if not term_lines:
             term_lines = [(Date.today(), total)]
@@ -231,16 +464,7 @@ class WizardSalePayment(Wizard):
             else:
                 to_pay= amount
         else:
-            to_pay = Decimal(0.0)
-            sales = Sale.search([('description', '=', sale.description)])
-            for sale in sales:
-                if sale.total_amount > Decimal(0.0):
-                    if sale.paid_amount:
-                        if sale.paid_amount > Decimal(0.0) and sale.state != "done":
-                            to_pay = sale.paid_amount * (-1)
-                    else:
-                        if sale.state == "done":
-                            to_pay = sale.total_amount * (-1)
+            to_pay = sale.get_refund_amount()
 
         return {
             'journal': sale_device.journal.id
@@ -251,27 +475,34 @@ class WizardSalePayment(Wizard):
             'party': sale.party.id,
             'tipo_p':tipo_p,
             'anticipo' : amount_a,
-            'lineas_anticipo' : str(lines_credits),
+            'lineas_anticipo' : lines_credits,
             'credito' : credito,
             'amount': total
             }
 
     def transition_pay_(self):
+        sale_id = Transaction().context.get('active_id', False)
+        with span('transition_pay_', sale=sale_id):
+            return self._transition_pay_()
+
+    def _transition_pay_(self):
         pool = Pool()
         Date = pool.get('ir.date')
         Sale = pool.get('sale.sale')
-        Statement = pool.get('account.statement')
+        Configuration = pool.get('sale.configuration')
         StatementLine = pool.get('account.statement.line')
         form = self.start
-        statements = Statement.search([
-                ('journal', '=', form.journal),
-                ('state', '=', 'draft'),
-                ], order=[('date', 'DESC')])
+        active_id = Transaction().context.get('active_id', False)
+        sale = Sale(active_id)
+        if not sale.reference:
+            Sale.set_reference([sale])
+            sale = Sale(active_id)
+        config = Configuration.get_payment_config(sale.company, Date.today(),
+            journal=form.journal)
+        statements = config['statements']
         if not statements:
             self.raise_user_error('not_draft_statement', (form.journal.name,))
 
-        active_id = Transaction().context.get('active_id', False)
-        sale = Sale(active_id)
         if sale.self_pick_up == False:
             sale.create_shipment('out')
             sale.set_shipment_state()
@@ -299,7 +530,6 @@ class WizardSalePayment(Wizard):
             sale.titular = form.titular
             sale.numero_cheque = form.numero_cheque
             sale.sale_date = date
-            sale.save()
 
         if form.tipo_p == 'deposito':
             sale.tipo_p = form.tipo_p
@@ -308,7 +538,6 @@ class WizardSalePayment(Wizard):
             sale.fecha_deposito = form.fecha_deposito
             sale.numero_deposito= form.numero_deposito
             sale.sale_date = date
-            sale.save()
 
         if form.tipo_p == 'tarjeta':
             sale.tipo_p = form.tipo_p
@@ -316,17 +545,18 @@ class WizardSalePayment(Wizard):
             sale.lote = form.lote
             sale.tarjeta = form.tarjeta
             sale.sale_date = date
-            sale.save()
 
         if form.tipo_p == 'efectivo':
             sale.tipo_p = form.tipo_p
             sale.recibido = form.recibido
             sale.cambio = form.cambio_cliente
             sale.sale_date = date
-            sale.save()
 
-        if not sale.reference:
-            Sale.set_reference([sale])
+        if sale.acumulativo != True:
+            sale.formas_pago_sri = form.tipo_pago_sri
+            sale.description = sale.reference
+        # all the payment values are written at once
+        sale.save()
 
         account = (sale.party.account_receivable
             and sale.party.account_receivable.id
@@ -334,159 +564,73 @@ class WizardSalePayment(Wizard):
                 error_args=(sale.party.name,)))
 
         if form.payment_amount:
-            payment = StatementLine(
-                statement=statements[0].id,
-                date=Date.today(),
-                amount=form.payment_amount,
-                party=sale.party.id,
-                account=account,
-                description=sale.reference,
-                sale=active_id
-                )
-            payment.save()
+            with span('statement_line', sale=sale.id):
+                payment = StatementLine(
+                    statement=statements[0],
+                    date=Date.today(),
+                    amount=form.payment_amount,
+                    party=sale.party.id,
+                    account=account,
+                    description=sale.reference,
+                    sale=active_id
+                    )
+                payment.save()
 
         if sale.acumulativo != True:
             pago_en_cero = False
             utiliza_anticipo_venta = False
-            sale.formas_pago_sri = form.tipo_pago_sri
-            sale.save()
-            Sale.workflow_to_end([sale])
-            Invoice = Pool().get('account.invoice')
-            invoices = Invoice.search([('description','=',sale.reference)])
+            with span('workflow_to_end', sale=sale.id,
+                    lines=len(sale.lines)):
+                Sale.workflow_to_end([sale])
+            invoice = Sale.get_payment_invoices([sale])[sale.id]
             lote = False
             modules = None
             Module = pool.get('ir.module.module')
             modules = Module.search([('name', '=', 'nodux_sale_payment_advanced_payment'), ('state', '=', 'installed')])
             if modules:
-                move_invoice = None
-                for i in invoices:
-                    move_invoice = i.move
-                    invoice_advanced = i
+                AdvanceLine = pool.get('sale.advance.line')
+                invoice_advanced = invoice
                 #agregado para asientos de anticipos
-                Period = pool.get('account.period')
-                Move = pool.get('account.move')
-                Invoice = pool.get('account.invoice')
-                MoveLine = pool.get('account.move.line')
-                InvoiceAccountMoveLine = pool.get('account.invoice-account.move.line')
-                amount_a = Decimal(0.0)
-                account_types = ['receivable']
-
-                move_lines = MoveLine.search([
-                    ('party', '=', sale.party),
-                    ('account.kind', 'in', account_types),
-                    ('state', '=', 'valid'),
-                    ('reconciliation', '=', None),
-                    ('maturity_date', '=', None),
-                ])
-
-                for line in move_lines:
-                    lineas_anticipo_conciliar = (form.lineas_anticipo.replace("[", "").replace("]","").replace("'", "").replace("'", "")).split(",")
-                    for l in lineas_anticipo_conciliar:
-                        if str(line.id) == l:
-                            description = sale.reference
-                            new_advanced = form.anticipo-form.restante
-                            line.credit = Decimal(new_advanced)
-                            line.save()
-                            move = line.move
-                            move.description = description
-                            for m in move.lines:
-                                if m.debit > Decimal(0.0):
-                                    m.debit = Decimal(new_advanced)
-                                    m.save()
-                            move.save()
-                if form.restante > Decimal(0.0):
-                    Journal = pool.get('account.journal')
-                    journal_r = Journal.search([('type', '=', 'revenue')])
-                    for j in journal_r:
-                        journal_sale = j.id
-                    pago_en_cero = True
-                    utiliza_anticipo_venta = True
-                    #crear_nuevo_asiento
-                    move_lines_new = []
-                    line_move_ids = []
-                    reconcile_lines_advanced = []
-                    move, = Move.create([{
-                        'period': Period.find(sale.company.id, date=sale.sale_date),
-                        'journal': journal_sale,
-                        'date': sale.sale_date,
-                        'origin': str(sale),
-                    }])
-
-                    move_lines_new.append({
-                        'description': invoice_advanced.number,
-                        'debit': Decimal(0.0),
-                        'credit': form.restante,
-                        'account': invoice_advanced.party.account_receivable.id,
-                        'move': move.id,
-                        'party': sale.party.id,
-                        'journal': journal_sale,
-                        'period': Period.find(sale.company.id, date=sale.sale_date),
-                    })
-
-                    move_lines_new.append({
-                        'description': invoice_advanced.number,
-                        'debit': form.restante,
-                        'credit': Decimal(0.0),
-                        'account': 326,
-                        'move': move.id,
-                        'journal': journal_sale,
-                        'period': Period.find(sale.company.id, date=sale.sale_date),
-                    })
-                    created_lines = MoveLine.create(move_lines_new)
-
-
-                    Move.post([move])
+                if form.utilizar_anticipo and form.lineas_anticipo:
+                    AdvanceLine.check_available(sale.party,
+                        form.lineas_anticipo, form.anticipo)
+                    with span('consume_advances', sale=sale.id,
+                            party=sale.party.id,
+                            lines=len(form.lineas_anticipo)):
+                        if AdvanceLine.consume(sale, invoice_advanced,
+                                form.lineas_anticipo,
+                                form.anticipo - form.restante):
+                            pago_en_cero = True
+                            utiliza_anticipo_venta = True
 
 
             if sale.shop.lote != None:
                 lote = sale.shop.lote
 
-            if invoices:
-                for i in invoices:
-                    invoice = i
+            send = (invoice and sale.fisic_invoice != True
+                and lote == False)
+            if invoice:
                 invoice.formas_pago_sri = form.tipo_pago_sri
-                invoice.save()
                 if sale.comment:
                     invoice.comment = sale.comment
-                    invoice.save()
-
-            if sale.fisic_invoice == True :
-                invoice.number = sale.number_invoice
-                invoice.fisic_invoice = True
+                if sale.fisic_invoice == True :
+                    invoice.number = sale.number_invoice
+                    invoice.fisic_invoice = True
+                if send:
+                    invoice.einvoice_state = 'pending'
+                # all the invoice values are written at once
                 invoice.save()
-            else:
-                if lote == False:
-                    invoice.get_invoice_element()
-                    invoice.get_tax_element()
-                    invoice.generate_xml_invoice()
-                    invoice.get_detail_element()
-                    invoice.action_generate_invoice()
-                    invoice.connect_db()
 
+            if send:
+                EInvoiceJob = pool.get('sale.einvoice.job')
+                with span('einvoice', sale=sale.id):
+                    EInvoiceJob.enqueue([invoice])
 
-            sale.description = sale.reference
-            sale.save()
             if (pago_en_cero == True and utiliza_anticipo_venta == True) | (form.utilizar_anticipo == True and form.restante == Decimal(0.0)):
-                Line = pool.get('account.move.line')
-                account = sale.party.account_receivable
-                lines = []
-                amount = Decimal('0.0')
-                for invoice in sale.invoices:
-                    for line in invoice.lines_to_pay:
-                        if not line.reconciliation:
-                            lines.append(line)
-                            amount += line.debit - line.credit
-                moves = Move.search([('description', '=', sale.reference)])
-                for move in moves:
-                    if not move:
-                        continue
-                    for line in move.lines:
-                        if (not line.reconciliation and
-                                line.account.id == account.id):
-                            lines.append(line)
-                            amount += line.debit - line.credit
-                if lines and amount == Decimal('0.0'):
-                    Line.reconcile(lines)
+                AdvanceLine = pool.get('sale.advance.line')
+                with span('reconciliation', sale=sale.id,
+                        party=sale.party.id):
+                    AdvanceLine.reconcile_sale(sale)
 
             if sale.total_amount == sale.paid_amount:
                 #return 'print_'
@@ -500,21 +644,262 @@ class WizardSalePayment(Wizard):
                 #return 'print_'
                 return 'end'
         else:
-            if sale.total_amount != sale.paid_amount:
-                return 'end'
-            if (sale.total_amount == sale.paid_amount) | (sale.state != draft):
-                Invoice = Pool().get('account.invoice')
-                invoices = Invoice.search([('description','=',sale.reference)])
-                for i in invoices:
-                    invoice= i
-                invoice.get_invoice_element()
-                invoice.get_tax_element()
-                invoice.generate_xml_invoice()
-                invoice.get_detail_element()
-                invoice.action_generate_invoice()
-                invoice.connect_db()
-                sale.description = sale.reference
-                sale.save()
-                return 'end'
+            # cumulative sales are settled by Sale.settle_cumulative
+            Sale.update_cumulative([sale])
 
         return 'end'
+
+
+class SaleBatchPaymentStart(ModelView):
+    'Sale Batch Payment Start'
+    __name__ = 'sale.batch.payment.start'
+
+    sales = fields.Many2Many('sale.sale', None, None, 'Ventas',
+        readonly=True)
+    amount = fields.Numeric('Total a pagar', digits=(16, 2), readonly=True)
+
+
+class SaleBatchPaymentResult(ModelView):
+    'Sale Batch Payment Result'
+    __name__ = 'sale.batch.payment.result'
+
+    report = fields.Text('Resultado', readonly=True)
+
+
+class WizardSaleBatchPayment(Wizard):
+    'Wizard Sale Batch Payment'
+    __name__ = 'sale.batch.payment'
+    start = StateView('sale.batch.payment.start',
+        'nodux_sale_payment_advanced_payment.sale_batch_payment_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Pagar', 'pay_', 'tryton-ok', default=True),
+            ])
+    pay_ = StateTransition()
+    result = StateView('sale.batch.payment.result',
+        'nodux_sale_payment_advanced_payment.sale_batch_payment_result_view_form', [
+            Button('Ok', 'end', 'tryton-ok', default=True),
+            ])
+
+    @classmethod
+    def __setup__(cls):
+        super(WizardSaleBatchPayment, cls).__setup__()
+        cls._error_messages.update({
+                'not_tipo_p': ('No ha configurado el tipo de pago. \n-Seleccione el estado de cuenta en "Todos los estados de cuenta" \n-Seleccione forma de pago.'),
+                'not_sale_device': ('La venta %s no tiene un punto de venta asignado.'),
+                'not_journal': ('No se ha definido un libro diario por defecto para %s'),
+                'not_statement': ('No ha creado un estado de cuenta para %s '),
+                'not_account_receivable': ('El tercero %s no tiene cuenta por cobrar.'),
+                'not_amount': ('La venta %s no tiene saldo pendiente de pago.'),
+                'consumidor_final_credit': ('No se puede dar credito a consumidor final, monto a pagar no puede ser %s'),
+                'consumidor_final_amount': ('La factura supera los $200 de importe total, por cuanto no puede ser emitida a nombre de CONSUMIDOR FINAL'),
+                'acumulativo': ('La venta %s es acumulativa, debe pagarse desde el pago de la venta.'),
+                })
+
+    def default_start(self, fields):
+        sale_id = Transaction().context['active_id']
+        with span('default_start', sale=sale_id):
+            return self._default_start(fields)
+
+    def _default_start(self, fields):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        sales = Sale.browse(Transaction().context.get('active_ids', []))
+        amount = Decimal(0.0)
+        for sale in sales:
+            amount += sale.total_amount - (sale.paid_amount or Decimal(0.0))
+        return {
+            'sales': [s.id for s in sales],
+            'amount': amount,
+            }
+
+    def _get_config(self, sale):
+        'Return the payment configuration of the sale device'
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Date = pool.get('ir.date')
+        User = pool.get('res.user')
+        user = User(Transaction().user)
+        sale_device = sale.sale_device or user.sale_device
+        if not sale_device:
+            self.raise_user_error('not_sale_device', (sale.rec_name,))
+        if not sale_device.journal:
+            self.raise_user_error('not_journal', (sale_device.name,))
+        config = Configuration.get_payment_config(sale.company, Date.today(),
+            journal=sale_device.journal)
+        if not config['statements']:
+            self.raise_user_error('not_statement', (sale_device.name,))
+        if not config['tipo_p']:
+            self.raise_user_error('not_tipo_p')
+        return config
+
+    def transition_pay_(self):
+        sale_id = Transaction().context.get('active_id', False)
+        with span('transition_pay_', sale=sale_id):
+            return self._transition_pay_()
+
+    def _transition_pay_(self):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        MoveLine = pool.get('account.move.line')
+        SalePaymentForm = pool.get('sale.payment.form')
+        AdvanceLine = pool.get('sale.advance.line')
+        EInvoiceJob = pool.get('sale.einvoice.job')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        today = Date.today()
+
+        # the advances are locked before any payment is created
+        parties = {}
+        for sale in self.start.sales:
+            parties.setdefault(sale.company.id, set()).add(sale.party.id)
+        advances = {}
+        for company_id, party_ids in parties.iteritems():
+            for balance in AdvanceLine.get_balances(list(party_ids),
+                    company_id):
+                if balance['amount']:
+                    AdvanceLine.check_available(Party(balance['party']),
+                        MoveLine.browse(balance['lines']), balance['amount'])
+                advances[(balance['party'], company_id)] = balance['amount']
+        to_pay = []
+        report = []
+        for sale in self.start.sales:
+            try:
+                if sale.acumulativo == True:
+                    self.raise_user_error('acumulativo', (sale.rec_name,))
+                config = self._get_config(sale)
+                if not sale.party.account_receivable:
+                    self.raise_user_error('not_account_receivable',
+                        (sale.party.name,))
+                residual = (sale.total_amount
+                    - (sale.paid_amount or Decimal(0.0)))
+                if residual <= Decimal(0.0):
+                    self.raise_user_error('not_amount', (sale.rec_name,))
+                key = (sale.party.id, sale.company.id)
+                used = min(advances[key], residual)
+                amount = residual - used
+                if sale.party.vat_number == '9999999999999':
+                    if amount == Decimal(0.0):
+                        self.raise_user_error('consumidor_final_credit',
+                            (amount,))
+                    if sale.total_amount > 200:
+                        self.raise_user_error('consumidor_final_amount')
+            except UserError as e:
+                report.append(u'%s: %s' % (sale.rec_name, e.message))
+                continue
+            advances[key] -= used
+            to_pay.append((sale, config, amount, used))
+
+        if not to_pay:
+            self.result.report = u'\n'.join(report)
+            return 'result'
+
+        formas_pago_sri = SalePaymentForm.default_get(
+            ['tipo_pago_sri']).get('tipo_pago_sri')
+        try:
+            with savepoint('sale_batch_payment'):
+                to_send = self._pay(to_pay, today, formas_pago_sri)
+        except (DatabaseOperationalError, UserWarning):
+            raise
+        except Exception:
+            # pay the sales one by one, a failing sale is rolled back
+            # entirely and reported
+            paid = []
+            to_send = []
+            for item in to_pay:
+                try:
+                    with savepoint('sale_batch_payment'):
+                        to_send += self._pay([item], today, formas_pago_sri)
+                except (DatabaseOperationalError, UserWarning):
+                    raise
+                except Exception as e:
+                    report.append(u'%s: %s' % (item[0].rec_name,
+                            _error_message(e)))
+                else:
+                    paid.append(item)
+            to_pay = paid
+
+        EInvoiceJob.enqueue(Invoice.browse([i.id for i in to_send]))
+        report += [u'%s: OK' % s.rec_name for s, _, _, _ in to_pay]
+        self.result.report = u'\n'.join(report)
+        return 'result'
+
+    def _pay(self, to_pay, today, formas_pago_sri):
+        '''
+        Pay the sales: a statement line for each amount to pay, the workflow
+        of all the sales at once and the advances they use.
+        Return the invoices to send.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Invoice = pool.get('account.invoice')
+        StatementLine = pool.get('account.statement.line')
+        AdvanceLine = pool.get('sale.advance.line')
+
+        sales = [s for s, _, _, _ in to_pay]
+        for sale in sales:
+            if sale.self_pick_up == False:
+                sale.create_shipment('out')
+                sale.set_shipment_state()
+        Sale.set_reference([s for s in sales if not s.reference])
+        sales = Sale.browse([s.id for s in sales])
+
+        to_write = []
+        for sale, (_, config, _, _) in zip(sales, to_pay):
+            to_write.extend(([sale], {
+                        'tipo_p': config['tipo_p'],
+                        'sale_date': today,
+                        'formas_pago_sri': (sale.formas_pago_sri
+                            or formas_pago_sri),
+                        'description': sale.reference,
+                        }))
+        Sale.write(*to_write)
+        sales = Sale.browse([s.id for s in sales])
+
+        payments = []
+        for sale, (_, config, amount, _) in zip(sales, to_pay):
+            if not amount:
+                continue
+            payments.append({
+                    'statement': config['statements'][0],
+                    'date': today,
+                    'amount': amount,
+                    'party': sale.party.id,
+                    'account': sale.party.account_receivable.id,
+                    'description': sale.reference,
+                    'sale': sale.id,
+                    })
+        if payments:
+            StatementLine.create(payments)
+
+        Sale.workflow_to_end(sales)
+
+        invoices = Sale.get_payment_invoices(sales)
+        to_send = []
+        for sale, (_, _, _, used) in zip(sales, to_pay):
+            invoice = invoices[sale.id]
+            if used:
+                advances = AdvanceLine.get_advances(sale.party, sale.company)
+                if sum((a.amount for a in advances), Decimal(0.0)) < used:
+                    AdvanceLine.raise_user_error('advance_changed',
+                        (sale.party.rec_name,))
+                AdvanceLine.consume(sale, invoice, [a.line for a in advances],
+                    used)
+                AdvanceLine.reconcile_sale(sale)
+            if invoice:
+                values = {
+                    'formas_pago_sri': sale.formas_pago_sri,
+                    }
+                if sale.fisic_invoice == True:
+                    values['number'] = sale.number_invoice
+                    values['fisic_invoice'] = True
+                elif not sale.shop.lote:
+                    values['einvoice_state'] = 'pending'
+                    to_send.append(invoice)
+                Invoice.write([invoice], values)
+        return to_send
+
+    def default_result(self, fields):
+        return {
+            'report': self.result.report,
+            }
@@ -0,0 +1,38 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['StatementLine']
+__metaclass__ = PoolMeta
+
+
+class StatementLine:
+    __name__ = 'account.statement.line'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        lines = super(StatementLine, cls).create(vlist)
+        Sale.update_cumulative([l.sale for l in lines if l.sale])
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        lines = sum(args[0::2], [])
+        # the lines may be moved from one sale to another
+        sales = [l.sale for l in lines if l.sale]
+        super(StatementLine, cls).write(*args)
+        sales += [l.sale for l in cls.browse([l.id for l in lines]) if l.sale]
+        Sale.update_cumulative(sales)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        sales = [l.sale for l in lines if l.sale]
+        super(StatementLine, cls).delete(lines)
+        Sale.update_cumulative(sales)
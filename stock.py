@@ -0,0 +1,27 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['StockMove']
+__metaclass__ = PoolMeta
+
+
+class StockMove:
+    __name__ = 'stock.move'
+
+    @classmethod
+    def create(cls, vlist):
+        moves = super(StockMove, cls).create(vlist)
+        Pool().get('sale.sale')._payment_stock_cache.clear()
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        super(StockMove, cls).write(*args)
+        Pool().get('sale.sale')._payment_stock_cache.clear()
+
+    @classmethod
+    def delete(cls, moves):
+        super(StockMove, cls).delete(moves)
+        Pool().get('sale.sale')._payment_stock_cache.clear()
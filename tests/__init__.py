@@ -0,0 +1,19 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import unittest
+
+try:
+    from trytond.modules.nodux_sale_payment_advanced_payment.tests import (
+        test_advance_concurrency, test_import_time)
+except ImportError:
+    from . import test_advance_concurrency, test_import_time
+
+__all__ = ['suite']
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(test_import_time.suite())
+    suite.addTests(test_advance_concurrency.suite())
+    return suite
@@ -0,0 +1,55 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Concurrent use of the same advance.
+
+It needs a PostgreSQL database prepared like for the load test, set with:
+
+    SALE_PAYMENT_DATABASE  the database name
+    SALE_PAYMENT_TEMPLATE  the id of the draft sale to copy
+    SALE_PAYMENT_CONFIG    the trytond configuration file, optional
+'''
+import os
+import argparse
+import unittest
+
+DATABASE = os.environ.get('SALE_PAYMENT_DATABASE')
+TEMPLATE = os.environ.get('SALE_PAYMENT_TEMPLATE')
+CONFIG = os.environ.get('SALE_PAYMENT_CONFIG')
+
+
+@unittest.skipUnless(DATABASE and TEMPLATE,
+    'SALE_PAYMENT_DATABASE and SALE_PAYMENT_TEMPLATE are not set')
+class AdvanceConcurrencyTestCase(unittest.TestCase):
+    'Test the concurrent use of the same advance'
+
+    def setUp(self):
+        from trytond import backend
+        from trytond.config import config
+        from trytond.pool import Pool
+
+        if CONFIG:
+            config.update_etc(CONFIG)
+        if backend.name() != 'postgresql':
+            self.skipTest('the advance is only locked on PostgreSQL')
+        Pool(DATABASE).init()
+        self.options = argparse.Namespace(database=DATABASE,
+            template=int(TEMPLATE), user='admin')
+
+    def test_consume_whole_advance(self):
+        'The payment waiting for a consumed advance fails and is retried'
+        from trytond.modules.nodux_sale_payment_advanced_payment.loadtest \
+            import set_user, check_concurrent_consume
+
+        set_user(self.options)
+        first, second = check_concurrent_consume(self.options)
+        self.assertEqual(first, 'ok')
+        self.assertEqual(second, 'serialization')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            AdvanceConcurrencyTestCase))
+    return suite
@@ -0,0 +1,24 @@
+# This file is part of the nodux_sale_payment_advanced_payment module for
+# Tryton. The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import unittest
+
+from trytond.modules.nodux_sale_payment_advanced_payment.benchmark import (
+    import_time, IMPORT_BUDGET)
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    'Test the import time of the module'
+
+    def test_import_time(self):
+        'The module is imported within the budget'
+        seconds = import_time()
+        self.assertLessEqual(seconds, IMPORT_BUDGET,
+            'import took %.3fs, budget %.3fs' % (seconds, IMPORT_BUDGET))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            ImportTimeTestCase))
+    return suite